@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+benchmarks of the backup data path: tar, hash, compress, encrypt, streaming/seekable
+backups, the first run of a repository and prepare_backup() + upload to a local rclone remote
+
+  bench.py run --recipient KEY --out new.json
+  bench.py compare old.json new.json --threshold 10
+
+each stage runs in a fresh process so its peak RSS (and the one of gpg/rclone) is its own
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import logging
+import platform
+import resource
+import subprocess
+import importlib.util
+import multiprocessing
+from argparse import Namespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+# synthetic trees, their sizes are multiplied by --scale
+PROFILES = ['small', 'huge', 'media', 'deep']
+STAGES = ['scan', 'tar', 'hash', 'compress', 'encrypt', 'stream', 'seekable', 'repository',
+          'prepare_upload']
+MB = 1024 * 1024
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for the st-backup data path')
+    subparsers = parser.add_subparsers(dest='mode')
+    subparsers.required = True
+
+    subp_run = subparsers.add_parser('run', help='Run the benchmarks.')
+    subp_run.add_argument('-o', '--out', type=str, required=True,
+                          help='JSON file to write the results to')
+    subp_run.add_argument('-w', '--workdir', type=str, default='/tmp/st-backup-bench',
+                          help='Where the synthetic trees and the outputs are written')
+    subp_run.add_argument('-s', '--scale', type=float, default=1.0,
+                          help='Size factor of the synthetic trees (1 = 100k small files, 3x256MB huge files...)')
+    subp_run.add_argument('-p', '--profiles', type=str, default=','.join(PROFILES),
+                          help='Comma separated trees to benchmark: ' + ' '.join(PROFILES))
+    subp_run.add_argument('--stages', type=str, default=','.join(STAGES),
+                          help='Comma separated stages to run: ' + ' '.join(STAGES))
+    subp_run.add_argument('-r', '--recipient', type=str, default=None,
+                          help='gpg recipient, stages that encrypt are skipped without it')
+    subp_run.add_argument('--rclone', type=str, default=shutil.which('rclone'),
+                          help='rclone binary for the upload stage, skipped if not found')
+    subp_run.add_argument('-c', '--codec', type=str, default='gzip:6',
+                          help='Compression codec, name[:level]')
+    subp_run.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1,
+                          help='Compress workers')
+    subp_run.add_argument('-n', '--repeat', type=int, default=1,
+                          help='Runs of each stage, the fastest one is kept')
+
+    subp_compare = subparsers.add_parser(
+        'compare', help='Compare two result files.')
+    subp_compare.add_argument('old', type=str)
+    subp_compare.add_argument('new', type=str)
+    subp_compare.add_argument('-t', '--threshold', type=float, default=10.0,
+                              help='Percent of throughput lost (or peak RSS gained) that counts as a regression')
+    return parser.parse_args()
+
+
+# -- synthetic trees --------------------------------------------------------
+
+def _text(rng, size):
+    # compressible, word-like content
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 10)))
+             for _ in range(2000)]
+    out = []
+    total = 0
+    while total < size:
+        w = rng.choice(words)
+        out.append(w)
+        total += len(w) + 1
+    return ' '.join(out).encode('ascii')[:size]
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def generate(profile, path, scale, seed=1):
+    """
+    writes a reproducible tree for profile in path
+    """
+    rng = random.Random('{}-{}'.format(profile, seed))
+    base = _text(rng, MB)
+    if profile == 'small':
+        # lots of small text files, 1000 per directory
+        for i in range(int(100000 * scale)):
+            size = rng.randint(0, 4096)
+            start = rng.randint(0, len(base) - size)
+            _write(os.path.join(path, 'd{:04d}'.format(i // 1000), 'f{:06d}.txt'.format(i)),
+                   base[start:start + size])
+    elif profile == 'huge':
+        # a few big compressible files
+        for i in range(3):
+            with open(os.path.join(path, 'huge{}.bin'.format(i)), 'wb') as f:
+                for _ in range(int(256 * scale)):
+                    f.write(base)
+    elif profile == 'media':
+        # incompressible, like photos or videos
+        for i in range(20):
+            _write(os.path.join(path, 'media', 'v{:02d}.mp4'.format(i)),
+                   rng.randbytes(int(16 * MB * scale)))
+    elif profile == 'deep':
+        # deep nesting, few bytes
+        for branch in range(int(max(1, 50 * scale))):
+            d = os.path.join(path, 'b{:03d}'.format(branch))
+            for level in range(64):
+                d = os.path.join(d, 'l{:02d}'.format(level))
+                _write(os.path.join(d, 'f.txt'), base[level:level + 256])
+    else:
+        raise ValueError("Unknown profile: {}".format(profile))
+
+
+def tree(workdir, profile, scale):
+    # trees are reused while the generator parameters don't change
+    path = os.path.join(workdir, 'trees', profile)
+    marker = os.path.join(workdir, 'trees', profile + '.json')
+    params = {'profile': profile, 'scale': scale, 'seed': 1}
+    if os.path.isfile(marker):
+        with open(marker) as f:
+            if json.load(f) == params:
+                return path
+    shutil.rmtree(path, ignore_errors=True)
+    logging.info("Generating tree {} (scale {})".format(profile, scale))
+    os.makedirs(path)
+    generate(profile, path, scale)
+    with open(marker, 'w') as f:
+        json.dump(params, f)
+    return path
+
+
+# -- stages ------------------------------------------------------------------
+
+def _load_st_backup():
+    spec = importlib.util.spec_from_file_location(
+        'st_backup', os.path.join(ROOT, 'st-backup.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _bench_config(opts, src, out):
+    # minimal config: one non Syncthing folder and a local rclone remote named 'bench'
+    config_file = os.path.join(out, 'config.ini')
+    with open(config_file, 'w') as f:
+        f.write('\n'.join([
+            '[DEFAULT]',
+            'Workdir = ' + os.path.join(out, 'workdir'),
+            'Statedir = ' + os.path.join(out, 'state'),
+            'Rclone_path = ' + os.path.dirname(os.path.realpath(opts.rclone)),
+            'Remote_root = ' + os.path.join(out, 'remote'),
+            'Recipients = ' + opts.recipient,
+            'Compression = ' + opts.codec,
+            'Compress_workers = {}'.format(opts.workers),
+            'Index_ttl = 0',
+            'ST_Https = False', 'ST_Host = localhost', 'ST_Port = 8384', 'ST_Apikey = none',
+            '[bench]', 'Type = Remote', 'Enabled = True', 'Folders = data',
+            'Maxbackups = 1', 'Minfiles = 0',
+            '[data]', 'Type = Folder', 'Enabled = True', 'Syncthing = False',
+            'Path = ' + src, 'DOW = 0123456', '',
+        ]))
+    return config_file
+
+
+def run_stage(stage, src, out, opts):
+    """
+    runs stage on the tree src, returns the bytes it processed
+    """
+    from lib.tarpress import create_tar, compress, stream_backup, seekable_backup, get_codec
+    from lib.gpgwrapper import gpg_encrypt
+    from lib.manifest import build_manifest, folder_size
+    from lib.md5 import md5
+
+    codec = get_codec(opts.codec)
+    tar_path = os.path.join(out, 'data.tar')
+    if stage == 'scan':
+        build_manifest(src)
+        return folder_size(src)
+    elif stage == 'tar':
+        create_tar(src, tar_path)
+        return os.path.getsize(tar_path)
+    elif stage == 'hash':
+        md5(tar_path)
+        return os.path.getsize(tar_path)
+    elif stage == 'compress':
+        # compress() replaces its input, keep the tar for the next stages
+        shutil.copyfile(tar_path, tar_path + '.in')
+        t0 = time.time()
+        compressed = compress(tar_path + '.in', opts.workers, codec)
+        os.rename(compressed, tar_path + '.compressed')
+        return os.path.getsize(tar_path), time.time() - t0
+    elif stage == 'encrypt':
+        shutil.copyfile(tar_path + '.compressed', tar_path + '.enc')
+        t0 = time.time()
+        gpg_encrypt(tar_path + '.enc', opts.recipient)
+        return os.path.getsize(tar_path + '.compressed'), time.time() - t0
+    elif stage == 'stream':
+        stream_backup(src, os.path.join(out, 'stream.gpg'), opts.recipient,
+                      opts.workers, codec)
+        return folder_size(src)
+    elif stage == 'seekable':
+        seekable_backup(src, os.path.join(out, 'seekable.gpg'), opts.recipient,
+                        opts.workers, codec)
+        return folder_size(src)
+    elif stage == 'repository':
+        # first run: every chunk is new and packed for a single remote
+        import configparser
+        from lib.repository import repository_backup
+        sections = configparser.ConfigParser()
+        sections.read_dict({'bench': {}, 'data': {'Path': src, 'Compression': str(codec)}})
+        shutil.rmtree(os.path.join(out, 'repository'), ignore_errors=True)
+        repository_backup(sections['data'], [sections['bench']],
+                          os.path.join(out, 'repository', 'workdir'),
+                          os.path.join(out, 'repository', 'state'), opts.recipient, 16 * MB)
+        return folder_size(src)
+    elif stage == 'prepare_upload':
+        from lib.stconfig import Config
+        os.environ['RCLONE_CONFIG_BENCH_TYPE'] = 'local'
+        shutil.rmtree(os.path.join(out, 'remote'), ignore_errors=True)
+        st_backup = _load_st_backup()
+        cfg = Config(Namespace(config=[_bench_config(opts, src, out)], mode='backup',
+                               archive=True), ROOT)
+        cfg.setup_rclone(update=False)
+        remote, folder = cfg.remotes[0], cfg.folders[0]
+        backup_path = st_backup.prepare_backup(cfg, remote, folder)
+        if st_backup.upload(cfg, remote, folder, backup_path) != 0:
+            raise RuntimeError("upload failed")
+        os.remove(backup_path)
+        return folder_size(src)
+    raise ValueError("Unknown stage: {}".format(stage))
+
+
+def _child(stage, src, out, opts, queue):
+    logging.basicConfig(level=logging.WARNING)
+    t0 = time.time()
+    try:
+        result = run_stage(stage, src, out, opts)
+    except BaseException as ex:
+        queue.put({'error': '{}: {}'.format(type(ex).__name__, ex)})
+        return
+    # stages that copy their input first report their own time
+    if isinstance(result, tuple):
+        nbytes, seconds = result
+    else:
+        nbytes, seconds = result, time.time() - t0
+    queue.put({
+        'bytes': nbytes,
+        'seconds': round(seconds, 4),
+        # ru_maxrss is in KB on linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'children_peak_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    })
+
+
+def measure(stage, src, out, opts):
+    ctx = multiprocessing.get_context('spawn')
+    best = None
+    for _ in range(opts.repeat):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_child, args=(stage, src, out, opts, queue))
+        proc.start()
+        result = queue.get()
+        proc.join()
+        if 'error' in result:
+            return result
+        if best is None or result['seconds'] < best['seconds']:
+            rss = max(result['peak_rss_mb'], best['peak_rss_mb']) if best else result['peak_rss_mb']
+            best = dict(result, peak_rss_mb=rss)
+    best['mb_s'] = round(best['bytes'] / MB / max(best['seconds'], 1e-6), 2)
+    return best
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', '-C', ROOT, 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(opts):
+    profiles = [p for p in opts.profiles.split(',') if p]
+    stages = [s for s in opts.stages.split(',') if s]
+    for s in stages:
+        if s not in STAGES:
+            logging.error("Unknown stage: {}".format(s))
+            sys.exit(1)
+    results = dict()
+    for profile in profiles:
+        src = tree(opts.workdir, profile, opts.scale)
+        out = os.path.join(opts.workdir, 'out', profile)
+        shutil.rmtree(out, ignore_errors=True)
+        os.makedirs(out)
+        results[profile] = dict()
+        for stage in stages:
+            if stage in ('encrypt', 'stream', 'seekable', 'repository', 'prepare_upload') \
+                    and not opts.recipient:
+                results[profile][stage] = {'skipped': 'no --recipient'}
+            elif stage == 'prepare_upload' and not opts.rclone:
+                results[profile][stage] = {'skipped': 'no rclone binary'}
+            elif stage in ('hash', 'compress') and 'tar' not in stages \
+                    or stage == 'encrypt' and 'compress' not in stages:
+                results[profile][stage] = {'skipped': 'needs the previous stage'}
+            else:
+                results[profile][stage] = measure(stage, src, out, opts)
+            logging.info("{} {}: {}".format(profile, stage, results[profile][stage]))
+        shutil.rmtree(out, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'scale': opts.scale,
+        'codec': opts.codec,
+        'workers': opts.workers,
+        'results': results,
+    }
+    with open(opts.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info("Results written to {}".format(opts.out))
+
+
+def compare(opts):
+    """
+    prints the changes between two runs, exits with 1 if any stage regressed
+    """
+    with open(opts.old) as f:
+        old = json.load(f)
+    with open(opts.new) as f:
+        new = json.load(f)
+    regressions = 0
+    lines = [['Profile', 'Stage', 'Old MB/s', 'New MB/s', 'Change %', 'Old RSS', 'New RSS', '']]
+    for profile, stages in new['results'].items():
+        for stage, n in stages.items():
+            o = old['results'].get(profile, {}).get(stage)
+            if o is None or 'mb_s' not in o or 'mb_s' not in n:
+                continue
+            change = (n['mb_s'] - o['mb_s']) / max(o['mb_s'], 1e-6) * 100
+            verdict = ''
+            if change < -opts.threshold:
+                verdict = 'SLOWER'
+            elif n['peak_rss_mb'] > o['peak_rss_mb'] * (1 + opts.threshold / 100) \
+                    and n['peak_rss_mb'] - o['peak_rss_mb'] > 16:
+                verdict = 'MORE MEMORY'
+            regressions += verdict != ''
+            lines.append([profile, stage, o['mb_s'], n['mb_s'], round(change, 1),
+                          o['peak_rss_mb'], n['peak_rss_mb'], verdict])
+    widths = [max(len(str(line[i])) for line in lines) for i in range(len(lines[0]))]
+    print('{} -> {} (threshold {}%)'.format(old.get('commit'), new.get('commit'), opts.threshold))
+    for line in lines:
+        print('  '.join(str(v).ljust(w) for v, w in zip(line, widths)))
+    if regressions:
+        print('{} regression(s)'.format(regressions))
+        sys.exit(1)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s][%(levelname)s] %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    opts = get_args()
+    if opts.mode == 'run':
+        run(opts)
+    else:
+        compare(opts)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,93 @@
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from lib.incremental import is_incremental
+from lib.metrics import labelled
+from lib.repository import REPO_DIR, snapshot_folder, unreferenced_packs, forget_packs
+
+
+def plan_retention(entries, limits):
+    """
+    entries: paths relative to remote_root ('Syncthing/KeePass/<backup>'),
+    repository snapshots count as backups of their folder, packs are left to the pack gc
+    limits: {folder alias: maxbackups}, counted in chains (full + its incrementals)
+    returns {folder alias: (chains stored, [paths to delete])}, oldest backups first
+    """
+    groups = dict()
+    for path in entries:
+        fname = os.path.basename(path)
+        # skip Archived backups
+        if fname.startswith('ARC'):
+            continue
+        if path.startswith(REPO_DIR + '/'):
+            falias = snapshot_folder(path)
+        else:
+            falias = os.path.basename(os.path.dirname(path))
+        if falias not in limits:
+            # not a folder or not configured in this remote (maybe it was before)
+            continue
+        try:
+            timestamp = int(fname.split('_')[0])
+        except ValueError:
+            logging.error(
+                "This should not happen, offending line is:\n{}".format(path))
+            continue
+        groups.setdefault(falias, []).append((timestamp, path))
+
+    plan = dict()
+    for falias, backups in groups.items():
+        maxbackups = limits[falias]
+        backups.sort()
+        # a chain is a full backup and the incrementals that depend on it,
+        # chains are kept or deleted as a whole (without incrementals each backup is a chain)
+        chains = []
+        for _, path in backups:
+            if is_incremental(path) and chains:
+                chains[-1].append(path)
+            else:
+                chains.append([path])
+        excess = len(chains) - maxbackups
+        if excess <= 0:
+            logging.debug("F:{} - {}/{} (curr/max) - skipping...".format(
+                falias, len(chains), maxbackups))
+            continue
+        plan[falias] = (len(chains), [path for chain in chains[:excess] for path in chain])
+    return plan
+
+
+def cleanup_remote(cfg, remote):
+    logging.info("<< Cleaning {} >>".format(remote.name))
+    limits = dict()
+    for folder in cfg.folders:
+        val = cfg.get_folder_cfg_by_remote(remote, folder)
+        if val is not None:
+            limits[folder.name] = int(val[0])
+
+    entries = cfg.index.entries(remote)
+    plan = plan_retention(entries, limits)
+    to_delete = []
+    for falias, (stored, paths) in plan.items():
+        logging.info("{} - {} - {} backups over {}, deleting {} files".format(
+            remote.name, falias, stored, limits[falias], len(paths)))
+        for path in paths:
+            logging.info("{} - {} - deleting --> {}".format(remote.name, falias, path))
+        to_delete.extend(paths)
+    # packs no remaining snapshot references, the ones of the snapshots above included
+    packs = unreferenced_packs(cfg.rclone, remote, cfg.statedir, cfg.remote_root,
+                               entries, set(to_delete))
+    for path in packs:
+        logging.info("{} - unreferenced pack deleting --> {}".format(remote.name, path))
+    if not to_delete and not packs:
+        return
+    # forgotten before deleting, a chunk the index still has would never be uploaded again
+    forget_packs(cfg.statedir, remote, packs, [p for p in to_delete if p.startswith(REPO_DIR + '/')])
+    to_delete.extend(packs)
+
+    # a single rclone call for every backup to delete in this remote
+    if cfg.rclone.delete_files(remote, cfg.remote_root, to_delete) == 0:
+        for path in to_delete:
+            cfg.index.remove(remote, cfg.remote_root + '/' + path)
+        cfg.index.flush()
 
 
 def cleanup(cfg):
@@ -13,72 +101,10 @@ def cleanup(cfg):
             logging.debug("Deleting {}".format(folder['BackupReady']))
             os.remove(folder['BackupReady'])
 
-    # clean the older backup from each folder when maxbackups is reached
-    for remote in cfg.remotes:
-        logging.info("<< Cleaning {} >>".format(remote.name))
-        output = cfg.rclone.lsf(remote, cfg.remote_root,
-                                use_ls=True, ls_depth='9')
-
-        # create a dict to store current count of backups for each folder and the oldest file
-        backupdict = dict()
-        for f in cfg.folders:
-            backupdict.update({f.name: 0,
-                               f.name + '_max': None,
-                               f.name + '_oldest': None})
-
-        for line in output:
-            line = line.split()[1]
-            # skip Archived backups
-            if os.path.basename(line).startswith('ARC'):
-                continue
-            # try to get the folder alias
-            falias = os.path.split(os.path.split(line)[0])[1]
-            folder = cfg.get_folder_by_alias(falias)
-            if folder is None:
-                continue
-            # get maxbackups for this folder
-            val = cfg.get_folder_cfg_by_remote(remote, folder)
-            if val is None:
-                # folder is not configured in this remote (maybe it was before) skipping it
-                continue
-            maxbackups, _ = val
-            new_count = backupdict[folder.name] + 1
-            # update oldest file
-            if backupdict[folder.name + '_oldest'] == None:
-                backupdict[folder.name + '_oldest'] = line
-            else:
-                try:
-                    curr_timestamp = int(os.path.basename(line).split('_')[0])
-                    stored_timestamp = int(os.path.basename(
-                        backupdict[folder.name + '_oldest']).split('_')[0])
-                    if curr_timestamp < stored_timestamp:
-                        backupdict[folder.name + '_oldest'] = line
-                except Exception as ex:
-                    logging.error(
-                        "This should not happen, offending line is:\n{}".format(line))
-
-            # update the dict on each line
-            backupdict.update(
-                {folder.name: new_count, folder.name + '_max': maxbackups})
-
-        # now proceed at cleaning this remote
-        for folder in cfg.folders:
-            curr_count = int(backupdict[folder.name])
-            maxbackups = backupdict[folder.name + '_max']
-            if maxbackups is None:
-                # folder is probably not configured in this remote
-                continue
-            maxbackups = int(maxbackups)
-            if curr_count <= maxbackups:
-                # don't need to clean
-                logging.debug("R:{} - F:{} - {}/{} (curr/max) - skipping...".format(
-                    remote.name, folder.name, curr_count, maxbackups))
-                continue
-            # ok, we have to clean this
-            frpath = cfg.remote_root + '/' + \
-                backupdict[folder.name + '_oldest']
-            logging.info("{} - {}/{} (current/maxbackups) deleting --> {}".format(
-                folder.name, curr_count, maxbackups, frpath))
-            cfg.rclone.delete(remote, frpath)
+    # delete the older backups from each folder when maxbackups is reached, remotes in parallel
+    with ThreadPoolExecutor(max_workers=max(1, len(cfg.remotes))) as pool:
+        for job in [pool.submit(labelled(cleanup_remote, remote=remote.name), cfg, remote)
+                    for remote in cfg.remotes]:
+            job.result()
 
     logging.info("Finished!")
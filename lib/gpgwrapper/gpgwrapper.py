@@ -3,20 +3,26 @@ import sys
 import logging
 import subprocess
 from lib.timer import timer
+from lib.metrics import METRICS
 
 
 @timer
-def gpg_encrypt(fname, recipients):
+def gpg_encrypt(fname, recipients, dest_dir=None):
+    # the encrypted file goes next to fname unless dest_dir is given
     logging.info("Starting to encrypt %s", fname)
+    encrypted = os.path.join(dest_dir or os.path.dirname(fname),
+                             os.path.basename(fname) + '.gpg')
 
     cmd_recipients = ""
     for r in recipients.split(' '):
         cmd_recipients = cmd_recipients + ' -r ' + r
 
-    cmd = "gpg -e {} --batch --always-trust --quiet --yes {}".format(
+    cmd = "gpg -e {} --batch --always-trust --quiet --yes --output {} {}".format(
         cmd_recipients,
+        encrypted,
         fname
     )
+    size = os.path.getsize(fname)
     try:
         result = subprocess.check_output(
             cmd, stderr=subprocess.STDOUT, shell=True
@@ -26,7 +32,67 @@ def gpg_encrypt(fname, recipients):
         msg = txt.format(fname, type(ex).__name__)
         logging.error(msg)
         os.remove(fname)
+        if os.path.isfile(encrypted):
+            os.remove(encrypted)
         sys.exit(1)
 
     os.remove(fname)
-    return fname + '.gpg'
+    METRICS.add_bytes('gpg_encrypt', size, os.path.getsize(encrypted))
+    return encrypted
+
+
+def gpg_encrypt_pipe(dest_path, recipients, stderr):
+    """
+    start gpg encrypting its stdin into dest_path, returns the Popen object
+    stderr is a file: a pipe read only once the stream ends could fill up and block gpg
+    """
+    cmd = ['gpg', '-e']
+    for r in recipients.split(' '):
+        cmd = cmd + ['-r', r]
+    cmd = cmd + ['--batch', '--always-trust', '--quiet', '--yes',
+                 '--output', dest_path]
+    return subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=stderr,
+    )
+
+
+def gpg_decrypt_pipe(stdin):
+    """
+    start gpg decrypting stdin (a file or pipe) to its stdout, returns the Popen object
+    """
+    cmd = ['gpg', '-d', '--batch', '--quiet', '--yes']
+    return subprocess.Popen(
+        cmd,
+        stdin=stdin,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+
+def gpg_encrypt_bytes(data, recipients):
+    """
+    returns data encrypted for recipients, raises RuntimeError if gpg fails
+    """
+    cmd = ['gpg', '-e']
+    for r in recipients.split(' '):
+        cmd = cmd + ['-r', r]
+    cmd = cmd + ['--batch', '--always-trust', '--quiet', '--compress-algo', 'none']
+    result = subprocess.run(cmd, input=data, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode('utf8').strip())
+    return result.stdout
+
+
+def gpg_decrypt_bytes(data):
+    """
+    returns data decrypted, raises RuntimeError if gpg fails
+    """
+    result = subprocess.run(['gpg', '-d', '--batch', '--quiet'], input=data,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode('utf8').strip())
+    return result.stdout
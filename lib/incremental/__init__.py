@@ -0,0 +1 @@
+from .incremental import *
@@ -0,0 +1,56 @@
+import os
+import logging
+from lib.timer import timer
+from lib.manifest import scan_folder
+from lib.state import load_state, save_state
+
+# member (inside the folder) listing the paths deleted since the previous backup
+DELETED_LIST = '.st-backup-deleted'
+# marks incremental backups in their names: <time>_<md5>_<folder>.inc.tar.gz.gpg
+INC_MARK = '.inc.'
+
+
+def is_incremental(fname):
+    return INC_MARK in os.path.basename(fname)
+
+
+@timer
+def snapshot_scan(folder_path):
+    """
+    returns {relative path: [size, mtime_ns, is_dir]} for every entry under folder_path
+    """
+    snapshot = dict()
+    for relpath, size, mtime_ns, _ in scan_folder(folder_path):
+        is_dir = os.path.isdir(os.path.join(folder_path, relpath)) and \
+            not os.path.islink(os.path.join(folder_path, relpath))
+        snapshot[relpath] = [0 if is_dir else size, mtime_ns, is_dir]
+    return snapshot
+
+
+def diff_snapshot(old, new):
+    """
+    returns (changed, deleted): the paths added or modified in new, and the ones missing from it
+    """
+    changed = sorted(p for p, v in new.items() if old.get(p) != v)
+    deleted = sorted(p for p in old if p not in new)
+    return changed, deleted
+
+
+def snapshot_file(statedir, remote, folder):
+    return os.path.join(statedir, 'snapshots', remote.name, folder.name + '.json')
+
+
+def load_snapshot(statedir, remote, folder):
+    """
+    returns the snapshot of the last backup of folder in remote
+    {'files': {...}, 'since_full': incrementals uploaded since the last full} or None
+    """
+    state = load_state(snapshot_file(statedir, remote, folder))
+    return state if state else None
+
+
+def save_snapshot(statedir, remote, folder, files, since_full):
+    logging.debug("Saving snapshot of {} for {} ({} since full)".format(
+        folder.name, remote.name, since_full))
+    save_state(snapshot_file(statedir, remote, folder),
+               {'files': files, 'since_full': since_full})
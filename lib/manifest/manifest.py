@@ -0,0 +1,42 @@
+import os
+import logging
+import hashlib
+from lib.timer import timer
+
+
+def scan_folder(folder_path):
+    """
+    yields (relative path, size, mtime_ns, inode) for every entry under folder_path
+    """
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        with os.scandir(os.path.join(folder_path, reldir)) as it:
+            for entry in it:
+                relpath = os.path.join(reldir, entry.name)
+                st = entry.stat(follow_symlinks=False)
+                yield (relpath, st.st_size, st.st_mtime_ns, st.st_ino)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(relpath)
+
+
+@timer
+def build_manifest(folder_path):
+    """
+    returns a digest of the folder's file manifest, it changes whenever
+    a file is added, removed, renamed or modified
+    """
+    entries = sorted(scan_folder(folder_path))
+    h = hashlib.sha1()
+    for relpath, size, mtime_ns, inode in entries:
+        h.update('{}\0{}\0{}\0{}\n'.format(
+            relpath, size, mtime_ns, inode).encode('utf8', 'surrogateescape'))
+    logging.info("Manifest of {}: {} entries".format(folder_path, len(entries)))
+    return h.hexdigest()
+
+
+def folder_size(folder_path):
+    """
+    sum of the size of every entry under folder_path
+    """
+    return sum(size for _, size, _, _ in scan_folder(folder_path))
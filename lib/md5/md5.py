@@ -14,3 +14,38 @@ def md5(fname):
         for chunk in iter(lambda: f.read(chunk_size), b""):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
+
+
+class HashingWriter:
+    """
+    write-only file wrapper that hashes everything written through it,
+    md5 is always computed, extra algorithms (sha256, blake2b...) can be added
+    """
+
+    def __init__(self, fileobj, algorithms=()):
+        self.fileobj = fileobj
+        self.hashes = {'md5': hashlib.md5()}
+        for algo in algorithms:
+            self.hashes[algo] = hashlib.new(algo)
+        self.written = 0
+
+    def write(self, data):
+        for h in self.hashes.values():
+            h.update(data)
+        self.written += len(data)
+        return self.fileobj.write(data)
+
+    def tell(self):
+        return self.written
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        pass
+
+    def hexdigest(self, algo='md5'):
+        return self.hashes[algo].hexdigest()
+
+    def hexdigests(self):
+        return {algo: h.hexdigest() for algo, h in self.hashes.items()}
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    run metrics: per (stage, remote, folder) calls, wall and cpu seconds, bytes in/out,
+    latencies of the calls to external services, high-water marks and failures,
+    exported as a node_exporter textfile and a json report
+    the remote/folder labels come from context(), set by the thread doing the work
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start = time.time()
+        self.stages = dict()
+        self.calls = dict()
+        self.high_water = dict()
+        self.failures = dict()
+
+    def labels(self):
+        return getattr(self.local, 'labels', {'remote': '', 'folder': ''})
+
+    @contextmanager
+    def context(self, **labels):
+        """
+        labels (remote=, folder=) for the stages run by this thread inside the block
+        """
+        previous = self.labels()
+        self.local.labels = dict(previous, **labels)
+        try:
+            yield
+        finally:
+            self.local.labels = previous
+
+    def _stage(self, stage):
+        # called with the lock held
+        labels = self.labels()
+        key = (stage, labels['remote'], labels['folder'])
+        if key not in self.stages:
+            self.stages[key] = {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                'bytes_in': 0, 'bytes_out': 0}
+        return self.stages[key]
+
+    def record_stage(self, stage, wall, cpu):
+        with self.lock:
+            s = self._stage(stage)
+            s['calls'] += 1
+            s['wall_seconds'] += wall
+            s['cpu_seconds'] += cpu
+
+    def add_bytes(self, stage, bytes_in=0, bytes_out=0):
+        with self.lock:
+            s = self._stage(stage)
+            s['bytes_in'] += bytes_in
+            s['bytes_out'] += bytes_out
+
+    def observe(self, service, call, seconds):
+        # latency of a call to rclone or the Syncthing api
+        with self.lock:
+            c = self.calls.setdefault((service, call), {'count': 0, 'seconds': 0.0,
+                                                        'max_seconds': 0.0})
+            c['count'] += 1
+            c['seconds'] += seconds
+            c['max_seconds'] = max(c['max_seconds'], seconds)
+
+    def set_max(self, name, value):
+        with self.lock:
+            self.high_water[name] = max(self.high_water.get(name, 0), value)
+
+    def add_failure(self, kind):
+        # a step that didn't stop the run but left a backup undone: upload, prepare, no_space
+        with self.lock:
+            self.failures[kind] = self.failures.get(kind, 0) + 1
+
+    def failed(self):
+        with self.lock:
+            return sum(self.failures.values())
+
+    def report(self, mode, success):
+        """
+        returns the run as a dict
+        """
+        with self.lock:
+            stages = []
+            for (stage, remote, folder), s in sorted(self.stages.items()):
+                s = dict(s, stage=stage, remote=remote, folder=folder)
+                if s['bytes_in']:
+                    s['ratio'] = round(s['bytes_out'] / s['bytes_in'], 4)
+                if s['wall_seconds'] and s['bytes_in']:
+                    s['mb_s'] = round(s['bytes_in'] / (1024 * 1024) / s['wall_seconds'], 2)
+                stages.append(s)
+            calls = [dict(c, service=service, call=call)
+                     for (service, call), c in sorted(self.calls.items())]
+            return {
+                'mode': mode,
+                'success': success,
+                'start': self.start,
+                'duration_seconds': round(time.time() - self.start, 3),
+                'stages': stages,
+                'calls': calls,
+                'high_water': dict(self.high_water),
+                'failures': dict(self.failures),
+            }
+
+    def write_json(self, path, report):
+        _atomic_write(path, json.dumps(report, indent=2))
+
+    def write_textfile(self, path, report):
+        """
+        node_exporter textfile collector format, values are the ones of the last run
+        """
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append('# HELP st_backup_{} {}'.format(name, help_text))
+            lines.append('# TYPE st_backup_{} gauge'.format(name))
+            for labels, value in samples:
+                lbl = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items())
+                lines.append('st_backup_{}{} {}'.format(
+                    name, '{' + lbl + '}' if lbl else '', value))
+
+        mode = {'mode': report['mode']}
+        metric('last_run_timestamp_seconds', 'Start of the last run.',
+               [(mode, report['start'])])
+        metric('last_run_duration_seconds', 'Duration of the last run.',
+               [(mode, report['duration_seconds'])])
+        metric('last_run_success', '1 if the last run finished without errors.',
+               [(mode, int(report['success']))])
+        for key, help_text in [('calls', 'Calls of the stage.'),
+                               ('wall_seconds', 'Wall time spent in the stage.'),
+                               ('cpu_seconds', 'CPU time of the thread running the stage.'),
+                               ('bytes_in', 'Bytes read by the stage.'),
+                               ('bytes_out', 'Bytes written by the stage.'),
+                               ('ratio', 'bytes_out / bytes_in of the stage.'),
+                               ('mb_s', 'Throughput of the stage, MB read per second.')]:
+            metric('stage_' + key, help_text,
+                   [({k: s[k] for k in ('stage', 'remote', 'folder')}, s[key])
+                    for s in report['stages'] if key in s])
+        for key, help_text in [('count', 'Calls to the external service.'),
+                               ('seconds', 'Time waiting for the external service.'),
+                               ('max_seconds', 'Slowest call to the external service.')]:
+            metric('call_' + key, help_text,
+                   [({'service': c['service'], 'call': c['call']}, c[key])
+                    for c in report['calls']])
+        metric('high_water', 'Highest value seen during the run (workdir_bytes...).',
+               [({'name': k}, v) for k, v in sorted(report['high_water'].items())])
+        # always exported, so an alert on them has a series to look at
+        failures = dict({'upload': 0, 'prepare': 0, 'no_space': 0}, **report['failures'])
+        metric('failures', 'Backups left undone in the last run, by kind of failure.',
+               [({'kind': k}, v) for k, v in sorted(failures.items())])
+        _atomic_write(path, '\n'.join(lines) + '\n')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _atomic_write(path, text):
+    # the collector must never read a half written file
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+# metrics of the current run, shared by every module
+METRICS = Metrics()
+
+
+@contextmanager
+def stage(name):
+    """
+    records wall and cpu time of the block as stage name
+    """
+    t0 = time.time()
+    c0 = time.thread_time()
+    try:
+        yield
+    finally:
+        METRICS.record_stage(name, time.time() - t0, time.thread_time() - c0)
+
+
+def write_reports(textfile, report_dir, mode, success, keep=30):
+    """
+    writes the textfile (if set) and a json report in report_dir, keeping the last keep ones
+    """
+    report = METRICS.report(mode, success)
+    try:
+        if textfile:
+            METRICS.write_textfile(textfile, report)
+        if report_dir:
+            name = time.strftime('%Y%m%d%H%M%S', time.localtime(report['start']))
+            METRICS.write_json(os.path.join(report_dir, name + '_' + mode + '.json'), report)
+            reports = sorted(f for f in os.listdir(report_dir) if f.endswith('.json'))
+            for fname in reports[:-keep]:
+                os.remove(os.path.join(report_dir, fname))
+    except OSError as ex:
+        logging.warning("Could not write the metrics: {}".format(ex))
+
+
+def labelled(function, **labels):
+    """
+    returns function running with labels, for work handed to other threads
+    """
+    def wrapper(*args, **kwargs):
+        with METRICS.context(**labels):
+            return function(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,151 @@
+import logging
+import threading
+from collections import namedtuple
+from lib.timer import timer
+from lib.metrics import METRICS
+from lib.manifest import folder_size
+from lib.incremental import INC_MARK, load_snapshot
+from lib.restore import backup_time
+from lib.repository import pending_bytes
+
+# one (folder, remote) pair due in this run: the kind of backup, the bytes it's expected
+# to take in the remote and where the figure comes from ('history' or 'folder'),
+# the free bytes of the remote before it (None if unknown) and whether it fits
+Task = namedtuple('Task', ['folder', 'remote', 'kind', 'estimate', 'source', 'free', 'fits'])
+
+
+class RemoteSpace:
+    """
+    free bytes of each remote, from a single 'rclone about' per remote and run,
+    the bytes of the backups planned (and then uploaded) are taken from it
+    remotes which don't report their free space are never full
+    """
+
+    def __init__(self, rclone):
+        self.rclone = rclone
+        self.lock = threading.Lock()
+        self.free_bytes = dict()
+
+    def _free(self, remote):
+        # called with the lock held
+        if remote.name not in self.free_bytes:
+            free = self.rclone.about(remote).get('free')
+            self.free_bytes[remote.name] = None if free is None else int(free)
+        return self.free_bytes[remote.name]
+
+    def free(self, remote):
+        with self.lock:
+            return self._free(remote)
+
+    def take(self, remote, nbytes, planned=0):
+        """
+        takes nbytes from remote in place of the planned bytes taken before,
+        returns False (and gives the planned bytes back) if they don't fit
+        """
+        with self.lock:
+            free = self._free(remote)
+            if free is None:
+                return True
+            logging.debug("FREE: {} - Planned: {} - Filesize: {}".format(free, planned, nbytes))
+            if nbytes > free + planned:
+                self.free_bytes[remote.name] = free + planned
+                return False
+            self.free_bytes[remote.name] = free + planned - nbytes
+            return True
+
+    def release(self, remote, planned):
+        # nothing is uploaded in place of the planned bytes
+        self.take(remote, 0, planned)
+
+
+def backup_kind(cfg, remote, folder):
+    # the backup process_folder() builds for folder in remote
+    if cfg.is_repository(folder):
+        return 'repository'
+    if cfg.is_incremental(folder):
+        snapshot = load_snapshot(cfg.statedir, remote, folder)
+        if snapshot is not None and snapshot['since_full'] + 1 < int(folder['Full_every']):
+            return 'incremental'
+    if cfg.is_seekable(folder):
+        return 'seekable'
+    return 'stream' if cfg.streaming else 'full'
+
+
+def history_size(cfg, remote, folder, incremental):
+    """
+    returns the size of the latest backup of folder (incremental or not) in remote, or None
+    """
+    prefix = cfg.index.relpath(folder['RPath']) + '/'
+    sizes = dict()
+    for path, size in cfg.index.entries(remote).items():
+        name = path[len(prefix):]
+        if not path.startswith(prefix) or '/' in name or (INC_MARK in name) != incremental:
+            continue
+        try:
+            sizes[backup_time(name)] = size
+        except ValueError:
+            continue
+    return sizes[max(sizes)] if sizes else None
+
+
+def estimate_size(cfg, remote, folder, kind, remotes):
+    """
+    returns (bytes, source): the size of the previous backup of the same kind,
+    in remote or else in the other remotes, or the folder size when there's none
+    repository backups upload only the chunks remote lacks, the bytes of the files
+    changed since the last run or holding such chunks
+    """
+    if kind == 'repository':
+        size = pending_bytes(folder, remote, cfg.statedir)
+        if size is not None:
+            return size, 'history'
+    else:
+        for r in [remote] + [r for r in remotes if r is not remote]:
+            size = history_size(cfg, r, folder, kind == 'incremental')
+            if size is not None:
+                return size, 'history'
+    return int(folder['Size']), 'folder'
+
+
+@timer
+def plan_run(cfg, remotes):
+    """
+    works out the (folder, remote) pairs due in this run, in the order of the folders,
+    and takes their estimated size from the free space of each remote
+    returns a list of Task, the ones which don't fit are not to be built
+    """
+    logging.info("Planning the run...")
+    tasks = []
+    for folder in cfg.folders:
+        due = [r for r in remotes if cfg.should_backup(r, folder)]
+        if not due:
+            continue
+        folder['Size'] = str(folder_size(folder['Path']))
+        for remote in due:
+            kind = backup_kind(cfg, remote, folder)
+            estimate, source = estimate_size(cfg, remote, folder, kind, due)
+            free = cfg.space.free(remote)
+            fits = cfg.space.take(remote, estimate)
+            if not fits:
+                logging.warning("Skipping {} in {}: {} MB estimated, {} MB free".format(
+                    folder.name, remote.name, round(estimate / (1024 * 1024), 2),
+                    round(free / (1024 * 1024), 2)))
+                METRICS.add_failure('no_space')
+            tasks.append(Task(folder, remote, kind, estimate, source, free, fits))
+    return tasks
+
+
+def by_folder(tasks):
+    """
+    returns [(folder, [remotes], {remote name: estimate})] of the tasks which fit,
+    folders no remote can take are left out so they're never built
+    """
+    plan = []
+    for task in tasks:
+        if not task.fits:
+            continue
+        if not plan or plan[-1][0] is not task.folder:
+            plan.append((task.folder, [], {}))
+        plan[-1][1].append(task.remote)
+        plan[-1][2][task.remote.name] = task.estimate
+    return plan
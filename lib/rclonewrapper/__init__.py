@@ -1,2 +1,2 @@
 from .rclone_setup import rclone_setup
-from .rclone import Rclone
+from .rclone import Rclone, LsEntry
@@ -1,8 +1,28 @@
 import os
 import sys
+import json
+import time
+import tempfile
 import logging
 import subprocess
+from collections import namedtuple
 from lib.rclonewrapper.myexception import MyException
+from lib.metrics import METRICS
+
+# one lsjson record, hashes is a dict {'md5': ...} (empty unless requested)
+LsEntry = namedtuple('LsEntry', ['path', 'size', 'modtime', 'hashes'])
+
+
+def parse_lsjson_line(line):
+    """
+    rclone lsjson prints one object per line between '[' and ']',
+    returns an LsEntry or None for the lines that aren't records
+    """
+    line = line.strip().rstrip(',')
+    if not line.startswith('{'):
+        return None
+    e = json.loads(line)
+    return LsEntry(e['Path'], e['Size'], e.get('ModTime'), e.get('Hashes', {}))
 
 
 class Rclone:
@@ -14,14 +34,18 @@ class Rclone:
             sys.exit(1)
 
     def run_command(self, cmd):
+        output = ''
+        t0 = time.time()
         try:
             result = subprocess.Popen(
                 cmd.split(),
                 stderr=subprocess.STDOUT,
                 stdout=subprocess.PIPE,
             )
-            ret = result.wait()
+            # communicate() drains the pipe while waiting, wait() first could hang
             output = str(result.communicate()[0].decode('utf8').strip())
+            ret = result.returncode
+            METRICS.observe('rclone', cmd.split()[1], time.time() - t0)
         except Exception as ex:
             txt = "Failed to execute rclone command.\nException of type {0}. Arguments:\n{1!r}\n\n{2}"
             msg = txt.format(type(ex).__name__, ex.args, output)
@@ -35,6 +59,59 @@ class Rclone:
         ret, output = self.run_command(cmd)
         if ret != 0:
             logging.error("Could not delete: {}".format(output))
+        return ret
+
+    def delete_files(self, remote, folder, paths):
+        # paths are relative to folder, all of them are deleted with one call
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('\n'.join(paths) + '\n')
+        cmd = self.bin + ' delete --files-from ' + f.name + \
+            ' ' + remote.name + ':' + folder
+        ret, output = self.run_command(cmd)
+        os.remove(f.name)
+        if ret != 0:
+            logging.error("Could not delete: {}".format(output))
+        return ret
+
+    def iter_command(self, cmd):
+        """
+        yields stdout line by line without keeping the whole output in memory,
+        raises MyException with stderr if the command fails
+        """
+        # stderr goes to a file so it can't fill a pipe while stdout is read
+        t0 = time.time()
+        with tempfile.TemporaryFile() as err:
+            proc = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE,
+                                    stderr=err)
+            try:
+                for line in proc.stdout:
+                    yield line.decode('utf8')
+            finally:
+                proc.stdout.close()
+                ret = proc.wait()
+                METRICS.observe('rclone', cmd.split()[1], time.time() - t0)
+            if ret != 0:
+                err.seek(0)
+                raise MyException(err.read().decode('utf8').strip())
+
+    def iter_lsjson(self, remote, folder, recursive=False, hashes=False):
+        """
+        yields an LsEntry for each file in remote:folder
+        """
+        cmd = self.bin + ' lsjson --files-only ' + \
+            ('-R ' if recursive else '') + ('--hash ' if hashes else '') + \
+            remote.name + ':' + folder
+        try:
+            for line in self.iter_command(cmd):
+                entry = parse_lsjson_line(line)
+                if entry is not None:
+                    yield entry
+        except MyException as ex:
+            if 'directory not found' in str(ex).lower():
+                return
+            logging.error(
+                "Unknow error occurred calling: {}\n{}".format(cmd, ex))
+            sys.exit(1)
 
     def lsf(self, remote, folder, use_ls=False, ls_depth='1'):
         if use_ls:
@@ -58,6 +135,20 @@ class Rclone:
 
         return output.split('\n')
 
+    def cat(self, remote, filepath, offset=None, count=None):
+        """
+        starts streaming remote:filepath (or count bytes from offset) on stdout,
+        returns the Popen object
+        """
+        cmd = [self.bin, 'cat', remote.name + ':' + filepath]
+        if offset is not None:
+            cmd = cmd + ['--offset', str(offset)]
+        if count is not None:
+            cmd = cmd + ['--count', str(count)]
+        logging.debug("Running: {}".format(' '.join(cmd)))
+        return subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+
     def upload(self, rname, fname, dest):
         cmd = self.bin + ' mkdir ' + rname + ':' + dest
         self.run_command(cmd)
@@ -65,23 +156,17 @@ class Rclone:
         logging.debug("Running: {}".format(cmd))
         return self.run_command(cmd)
 
-    def check_space(self, remote, filesize=None):
-        if filesize is None:
-            cmd = self.bin + ' about ' + remote.name + ':'
-        else:
-            cmd = self.bin + ' about ' + remote.name + ': --full'
-
-        ret, output = self.run_command(cmd)
-        if ret != 0:
+    def about(self, remote):
+        """
+        returns {'total', 'used', 'free'...} in bytes, empty if the remote doesn't tell
+        """
+        # stdout only, a NOTICE on stderr would break the json
+        cmd = self.bin + ' about ' + remote.name + ': --json'
+        try:
+            return json.loads(''.join(self.iter_command(cmd)))
+        except MyException as ex:
             logging.error(
-                "Something went wrong calling: {}\n{}".format(cmd, output))
-
-        if filesize is None:
-            total = output.split()[1]
-            used = output.split()[3]
-            free = output.split()[5]
-            return total, used, free
-        else:
-            free = output.split()[5]
-            logging.debug("FREE: {} - Filesize: {}".format(free, filesize))
-            return int(free) > int(filesize)
+                "Something went wrong calling: {}\n{}".format(cmd, ex))
+        except ValueError:
+            logging.error("Unexpected output of: {}".format(cmd))
+        return dict()
@@ -0,0 +1,209 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import base64
+import socket
+import tempfile
+import secrets
+import logging
+import subprocess
+import http.client
+from lib.rclonewrapper.myexception import MyException
+from lib.metrics import METRICS
+from lib.rclonewrapper.rclone import LsEntry
+
+
+class RcloneRcd:
+    """
+    same interface as Rclone, but commands go to a single 'rclone rcd' started
+    once per run and called over pooled keep-alive http connections,
+    so rclone.conf, tokens and backend connections are set up only once
+    """
+
+    def __init__(self, rclone_bin, pool_size=8):
+        self.bin = rclone_bin
+        if not os.path.isfile(self.bin):
+            logging.error(
+                "Could not find rclone binary on {}".format(self.bin))
+            sys.exit(1)
+        self.pool = queue.LifoQueue()
+        self.pool_size = pool_size
+        self.proc = None
+        self.start()
+
+    def start(self):
+        # random credentials, the daemon only listens on localhost
+        user = secrets.token_hex(8)
+        password = secrets.token_hex(16)
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        auth = base64.b64encode('{}:{}'.format(user, password).encode('utf8'))
+        self.headers = {
+            'Authorization': 'Basic ' + auth.decode('ascii'),
+            'Content-Type': 'application/json',
+        }
+        cmd = [self.bin, 'rcd', '--rc-addr', '127.0.0.1:{}'.format(self.port)]
+        # credentials in the environment, any local user can read the command line
+        env = dict(os.environ, RCLONE_RC_USER=user, RCLONE_RC_PASS=password)
+        logging.info("Starting rclone rcd on port {}".format(self.port))
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL, env=env)
+        atexit.register(self.stop)
+
+        deadline = time.time() + 10
+        while True:
+            try:
+                version = self.call('core/version')
+                logging.info("rclone rcd {} ready".format(version['version']))
+                return
+            except MyException:
+                if self.proc.poll() is not None or time.time() > deadline:
+                    logging.error("Could not start rclone rcd")
+                    sys.exit(1)
+                time.sleep(0.1)
+
+    def stop(self):
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        try:
+            self.call('core/quit')
+            self.proc.wait(timeout=5)
+        except Exception:
+            self.proc.terminate()
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
+
+    def _get_conn(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            return http.client.HTTPConnection('127.0.0.1', self.port)
+
+    def _put_conn(self, conn):
+        if self.pool.qsize() < self.pool_size:
+            self.pool.put(conn)
+        else:
+            conn.close()
+
+    def _request(self, conn, command, body):
+        conn.request('POST', '/' + command, body, self.headers)
+        resp = conn.getresponse()
+        return resp, resp.read()
+
+    def call(self, command, params=None):
+        """
+        calls an rc command, raises MyException with rclone's error message on failure
+        """
+        body = json.dumps(params or {})
+        t0 = time.time()
+        conn = self._get_conn()
+        try:
+            resp, data = self._request(conn, command, body)
+        except (OSError, http.client.HTTPException):
+            # stale keep-alive connection, retry once with a new one
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', self.port)
+            try:
+                resp, data = self._request(conn, command, body)
+            except (OSError, http.client.HTTPException) as ex:
+                # the daemon is gone, the command fails like the cli one would
+                conn.close()
+                raise MyException("rclone rcd {} failed: {!r}".format(command, ex))
+        self._put_conn(conn)
+        METRICS.observe('rclone_rcd', command, time.time() - t0)
+        out = json.loads(data.decode('utf8')) if data else dict()
+        if resp.status != 200:
+            raise MyException(out.get('error', resp.reason))
+        return out
+
+    def _list(self, remote, folder, recursive=False, files_only=False, hashes=False):
+        try:
+            out = self.call('operations/list', {
+                'fs': remote.name + ':',
+                'remote': folder,
+                'opt': {'recurse': recursive, 'filesOnly': files_only,
+                        'showHash': hashes},
+            })
+        except MyException as ex:
+            if 'directory not found' in str(ex).lower():
+                return None
+            logging.error("Unknow error occurred listing {}:{}\n{}".format(
+                remote.name, folder, ex))
+            sys.exit(1)
+        return out['list']
+
+    def delete(self, remote, filepath):
+        try:
+            self.call('operations/deletefile',
+                      {'fs': remote.name + ':', 'remote': filepath})
+        except MyException as ex:
+            logging.error("Could not delete: {}".format(ex))
+            return 1
+        return 0
+
+    def delete_files(self, remote, folder, paths):
+        # paths are relative to folder, all of them are deleted with one call
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('\n'.join(paths) + '\n')
+        try:
+            self.call('operations/delete', {'fs': remote.name + ':' + folder,
+                                            '_filter': {'FilesFrom': [f.name]}})
+        except MyException as ex:
+            logging.error("Could not delete: {}".format(ex))
+            return 1
+        finally:
+            os.remove(f.name)
+        return 0
+
+    def iter_lsjson(self, remote, folder, recursive=False, hashes=False):
+        # the rc api answers with the whole listing, only the records are streamed
+        for e in self._list(remote, folder, recursive, True, hashes) or []:
+            yield LsEntry(e['Path'], e['Size'], e.get('ModTime'), e.get('Hashes', {}))
+
+    def lsf(self, remote, folder, use_ls=False, ls_depth='1'):
+        entries = self._list(remote, folder, recursive=use_ls,
+                             files_only=use_ls)
+        if entries is None:
+            return ['']
+        if use_ls:
+            # same format as 'rclone ls': '<size> <path>'
+            depth = int(ls_depth)
+            return ['{} {}'.format(e['Size'], e['Path']) for e in entries
+                    if e['Path'].count('/') < depth]
+        return [e['Name'] + ('/' if e['IsDir'] else '') for e in entries]
+
+    def cat(self, remote, filepath, offset=None, count=None):
+        # the rc api can't stream a file, this one goes through the cli
+        cmd = [self.bin, 'cat', remote.name + ':' + filepath]
+        if offset is not None:
+            cmd = cmd + ['--offset', str(offset)]
+        if count is not None:
+            cmd = cmd + ['--count', str(count)]
+        return subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+
+    def upload(self, rname, fname, dest):
+        try:
+            self.call('operations/mkdir', {'fs': rname + ':', 'remote': dest})
+            logging.debug("Copying {} to {}:{}".format(fname, rname, dest))
+            self.call('operations/copyfile', {
+                'srcFs': os.path.dirname(fname),
+                'srcRemote': os.path.basename(fname),
+                'dstFs': rname + ':',
+                'dstRemote': dest + '/' + os.path.basename(fname),
+            })
+        except MyException as ex:
+            return 1, str(ex)
+        return 0, ''
+
+    def about(self, remote):
+        try:
+            return self.call('operations/about', {'fs': remote.name + ':'})
+        except MyException as ex:
+            logging.error(
+                "Something went wrong calling about on {}\n{}".format(remote.name, ex))
+            return dict()
@@ -1,17 +1,111 @@
 import os
 import sys
+import time
+import hashlib
 import platform
 import logging
 import subprocess
-import urllib.request
+import tempfile
 import zipfile
 import shutil
+from lib.state import load_state, save_state
 
+DOWNLOADS_URL = "https://downloads.rclone.org"
 
-def rclone_setup(rclone_path):
+
+def rclone_setup(rclone_path, state_file, ttl):
+    """
+    installs or updates rclone in rclone_path, upstream is checked at most every ttl seconds,
+    if the check or the download fails the installed binary is kept
+    """
     logging.info("> Checking if rclone is updated <")
     rclone_bin = os.path.join(rclone_path, 'rclone')
+    if not os.path.isdir(rclone_path):
+        logging.info("rclone install path does not exist, creating it")
+        os.mkdir(rclone_path)
+        logging.info("created folder: {}".format(rclone_path))
+
+    state = load_state(state_file)
+    installed_version = get_installed_version(rclone_bin, state)
+    if installed_version is not None and time.time() - state.get('checked', 0) < ttl:
+        logging.info("Installed version: {} (checked upstream {} hours ago)".format(
+            installed_version, round((time.time() - state['checked']) / 3600, 1)))
+        return
+
+    try:
+        upstream_version = get_upstream_version()
+    except Exception as ex:
+        fallback(rclone_bin, "Failed to check upstream rclone version", ex)
+        return
+
+    logging.info("Installed version: {}".format(installed_version))
+    logging.info("Upstream  version: {}".format(upstream_version))
+
+    if installed_version != upstream_version:
+        logging.info(
+            "Downloading and installing rclone at {}".format(rclone_path))
+        try:
+            install_rclone(rclone_path, rclone_bin, upstream_version)
+        except Exception as ex:
+            fallback(rclone_bin, "Failed to update rclone", ex)
+            return
+        logging.info("rclone successfully updated")
+
+    save_state(state_file, {
+        'checked': time.time(),
+        'version': upstream_version,
+        'sha256': sha256sum(rclone_bin),
+    })
+
+
+def fallback(rclone_bin, txt, ex):
+    msg = "{0}.\nException of type {1}. Arguments:\n{2!r}".format(
+        txt, type(ex).__name__, ex.args)
+    if os.path.isfile(rclone_bin):
+        logging.warning(msg + "\nUsing the installed rclone binary")
+    else:
+        logging.error(msg)
+        sys.exit(1)
+
+
+def sha256sum(fname):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(4 * 1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
 
+
+def get_installed_version(rclone_bin, state):
+    """
+    the version is known without running rclone if the binary's hash matches the stored one
+    """
+    if not os.path.isfile(rclone_bin):
+        return None
+    if state.get('sha256') == sha256sum(rclone_bin):
+        return state.get('version')
+    # unknown binary (installed by hand?), ask it once
+    try:
+        # os.chmod is octal
+        os.chmod(rclone_bin, 0o775)
+        result = subprocess.check_output(
+            [rclone_bin, '--version'], stderr=subprocess.STDOUT)
+        return result.decode("utf8").split('\n')[0].split(' ')[1].strip()
+    except Exception as ex:
+        txt = "Failed to check rclone version.\nException of type {0}. Arguments:\n{1!r}"
+        msg = txt.format(type(ex).__name__, ex.args)
+        logging.error(msg)
+        return None
+
+
+def get_upstream_version():
+    # urllib.request is slow to import, only needed when checking upstream
+    import urllib.request
+    with urllib.request.urlopen(DOWNLOADS_URL + "/version.txt", timeout=10) as fp:
+        return fp.read().decode("utf8").rstrip().split(' ')[1].strip()
+
+
+def get_platform_strings():
     # TODO: implement more platforms
     os_string = platform.system().lower()
     arch_string = platform.machine()
@@ -23,79 +117,49 @@ def rclone_setup(rclone_path):
         arch_string = 'amd64'
     else:
         arch_string = '386'
+    return os_string, arch_string
 
-    if not is_rclone_updated(rclone_path, rclone_bin):
-        logging.info(
-            "Downloading and installing rclone at {}".format(rclone_path))
-        zip_file = os.path.join(rclone_path, 'rclone.zip')
-        url_string = "https://downloads.rclone.org/rclone-current-{}-{}.zip".format(
-            os_string, arch_string)
-        try:
-            urllib.request.urlretrieve(url_string, zip_file)
-        except Exception as ex:
-            txt = "Failed to update rclone.\nException of type {0}. Arguments:\n{1!r}"
-            msg = txt.format(type(ex).__name__, ex.args)
-            logging.error(msg)
-            try:
-                os.remove(zip_file)
-            except:
-                pass
-            sys.exit(1)
-
-        # we have downloaded the zip, lets unzip and check
-        with zipfile.ZipFile(zip_file) as Z:
-            for member in Z.namelist():
-                filename = os.path.basename(member)
-                # skip directories
-                if not filename:
-                    continue
-                # copy file (taken from zipfile's extract)
-                source = Z.open(member)
-                target = open(os.path.join(rclone_path, filename), "wb")
-                with source, target:
-                    shutil.copyfileobj(source, target)
 
-        # clean
-        os.remove(zip_file)
-
-        # final check
-        if is_rclone_updated(rclone_path, rclone_bin):
-            logging.info("rclone successfully updated")
-        else:
-            logging.error("Something went wrong updating rclone")
-            sys.exit(1)
-
-
-def is_rclone_updated(rclone_path, rclone_bin):
-    # check upstreams version of rclone
-    with urllib.request.urlopen("https://downloads.rclone.org/version.txt") as fp:
-        upstream_version = fp.read().decode(
-            "utf8").rstrip().split(' ')[1].strip()
-
-    # check installed version
-    installed_version = None
-    if os.path.isdir(rclone_path):
-        if os.path.isfile(rclone_bin):
-            try:
-                # os.chmod is octal
-                os.chmod(rclone_bin, 0o775)
-                cmd = rclone_bin + ' --version | head -n 1'
-                result = subprocess.check_output(
-                    cmd, stderr=subprocess.STDOUT, shell=True
-                )
-                installed_version = result.decode(
-                    "utf8").rstrip().split(' ')[1].strip()
-            except Exception as ex:
-                txt = "Failed to check rclone version.\nException of type {0}. Arguments:\n{1!r}"
-                msg = txt.format(type(ex).__name__, ex.args)
-                logging.error(msg)
-                sys.exit(1)
-    else:
-        logging.info("rclone install path does not exist, creating it")
-        os.mkdir(rclone_path)
-        logging.info("created folder: {}".format(rclone_path))
+def install_rclone(rclone_path, rclone_bin, version):
+    """
+    downloads the zip of version to a temp file, checks it against the published SHA256SUMS
+    and atomically replaces the binary
+    """
+    import urllib.request
+    os_string, arch_string = get_platform_strings()
+    zip_name = "rclone-{}-{}-{}.zip".format(version, os_string, arch_string)
+    base_url = "{}/{}/".format(DOWNLOADS_URL, version)
 
-    logging.info("Installed version: {}".format(installed_version))
-    logging.info("Upstream  version: {}".format(upstream_version))
+    with urllib.request.urlopen(base_url + "SHA256SUMS", timeout=30) as fp:
+        sums = fp.read().decode("utf8")
+    expected = None
+    for line in sums.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1].lstrip('*') == zip_name:
+            expected = parts[0]
+    if expected is None:
+        raise ValueError("{} not found in SHA256SUMS".format(zip_name))
+
+    fd, zip_file = tempfile.mkstemp(suffix='.zip', dir=rclone_path)
+    os.close(fd)
+    fd, tmp_bin = tempfile.mkstemp(dir=rclone_path)
+    os.close(fd)
+    try:
+        urllib.request.urlretrieve(base_url + zip_name, zip_file)
+        if sha256sum(zip_file) != expected:
+            raise ValueError("Checksum mismatch for {}".format(zip_name))
 
-    return installed_version == upstream_version
+        # we have downloaded and verified the zip, extract the binary
+        with zipfile.ZipFile(zip_file) as Z:
+            member = [m for m in Z.namelist()
+                      if os.path.basename(m) == 'rclone'][0]
+            with Z.open(member) as source, open(tmp_bin, "wb") as target:
+                shutil.copyfileobj(source, target)
+        # os.chmod is octal
+        os.chmod(tmp_bin, 0o775)
+        os.replace(tmp_bin, rclone_bin)
+    finally:
+        # clean
+        for f in (zip_file, tmp_bin):
+            if os.path.isfile(f):
+                os.remove(f)
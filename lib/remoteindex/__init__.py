@@ -0,0 +1 @@
+from .remoteindex import RemoteIndex
@@ -0,0 +1,96 @@
+import time
+import logging
+import threading
+from lib.state import load_state, save_state
+
+
+class RemoteIndex:
+    """
+    cached listing of the backups stored under remote_root in each remote,
+    built with one 'rclone lsjson -R' per remote and kept on disk for ttl seconds,
+    uploads and deletes update it in place so it stays consistent
+    paths are relative to remote_root: 'Syncthing/KeePass/<backup>'
+    """
+
+    def __init__(self, rclone, remote_root, cache_file, ttl):
+        self.rclone = rclone
+        self.remote_root = remote_root
+        self.cache_file = cache_file
+        self.ttl = ttl
+        # self.lock guards the cache, each remote is listed under its own lock
+        # so the listings of different remotes run at the same time
+        self.lock = threading.Lock()
+        self.remote_locks = dict()
+        self.dirty = False
+        self.cache = load_state(self.cache_file)
+
+    def _remote_lock(self, remote):
+        with self.lock:
+            return self.remote_locks.setdefault(remote.name, threading.Lock())
+
+    def _fetch(self, remote):
+        logging.info("Building the index of {}".format(remote.name))
+        entries = dict()
+        for e in self.rclone.iter_lsjson(remote, self.remote_root, recursive=True):
+            entries[e.path] = e.size
+        with self.lock:
+            self.cache[remote.name] = {'time': time.time(), 'entries': entries}
+            self.dirty = True
+        self.flush()
+        return dict(entries)
+
+    def _cached(self, remote):
+        with self.lock:
+            cached = self.cache.get(remote.name)
+            if cached is None or time.time() - cached['time'] > self.ttl:
+                return None
+            return dict(cached['entries'])
+
+    def entries(self, remote):
+        """
+        returns a dict {path: size} of the files stored in the remote
+        """
+        entries = self._cached(remote)
+        if entries is not None:
+            return entries
+        with self._remote_lock(remote):
+            # another thread may have listed it meanwhile
+            entries = self._cached(remote)
+            if entries is None:
+                entries = self._fetch(remote)
+            return entries
+
+    def flush(self):
+        """
+        writes the cache to disk if add() or remove() changed it since the last flush
+        """
+        with self.lock:
+            if self.dirty:
+                save_state(self.cache_file, self.cache)
+                self.dirty = False
+
+    def relpath(self, rpath):
+        # 'STBACKUP/Syncthing/KeePass' -> 'Syncthing/KeePass'
+        return rpath[len(self.remote_root):].strip('/')
+
+    def list_folder(self, remote, rpath):
+        """
+        returns the names of the files stored in rpath (remote_root/...)
+        """
+        prefix = self.relpath(rpath) + '/'
+        return [p[len(prefix):] for p in self.entries(remote)
+                if p.startswith(prefix) and '/' not in p[len(prefix):]]
+
+    def add(self, remote, rpath, size):
+        # written on flush(), once per run
+        with self.lock:
+            if remote.name in self.cache:
+                self.cache[remote.name]['entries'][self.relpath(rpath)] = size
+                self.dirty = True
+
+    def remove(self, remote, rpath):
+        with self.lock:
+            if remote.name in self.cache:
+                self.cache[remote.name]['entries'].pop(
+                    self.relpath(rpath), None)
+                self.dirty = True
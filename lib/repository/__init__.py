@@ -0,0 +1,2 @@
+from .chunker import iter_chunks
+from .repository import *
@@ -0,0 +1,268 @@
+import os
+import json
+import stat
+import hashlib
+import logging
+import tempfile
+from datetime import datetime
+from lib.timer import timer
+from lib.metrics import METRICS
+from lib.manifest import scan_folder
+from lib.state import load_state, save_state
+from lib.gpgwrapper import gpg_encrypt
+from lib.tarpress import get_codec, codec_compress
+from lib.repository.chunker import iter_chunks, is_fast
+
+# folder inside Remote_root holding the packs and snapshots of every folder
+REPO_DIR = 'Repository'
+SNAPSHOT_MARK = '.snapshot.json'
+
+
+class PackWriter:
+    """
+    appends chunks to a pack file, once it reaches pack_size it's encrypted and a new one started
+    locations: {chunk id: [pack id, offset, length, compressed, size]} of the finished packs,
+    compressed is the codec of the chunk ('xz:6'...), 0 if stored as is (1: zlib, older packs)
+    """
+
+    def __init__(self, workdir, recipients, pack_size):
+        self.workdir = workdir
+        self.recipients = recipients
+        self.pack_size = pack_size
+        self.packs = []
+        self.locations = dict()
+        self.f = None
+        os.makedirs(self.workdir, exist_ok=True)
+
+    def _start(self):
+        fd, self.path = tempfile.mkstemp(dir=self.workdir, suffix='.tmp')
+        self.f = os.fdopen(fd, 'wb')
+        self.hash = hashlib.sha256()
+        self.offset = 0
+        self.pending = dict()
+
+    def __contains__(self, chunk_id):
+        return chunk_id in self.locations or (self.f is not None and chunk_id in self.pending)
+
+    def add(self, chunk_id, payload, compressed, size):
+        if self.f is None:
+            self._start()
+        self.pending[chunk_id] = [self.offset, len(payload), compressed, size]
+        self.f.write(payload)
+        self.hash.update(payload)
+        self.offset += len(payload)
+        if self.offset >= self.pack_size:
+            self.flush()
+
+    def flush(self):
+        if self.f is None:
+            return
+        self.f.close()
+        self.f = None
+        # packs are named after their content
+        pack_id = self.hash.hexdigest()[:32]
+        pack_path = os.path.join(self.workdir, pack_id + '.pack')
+        os.rename(self.path, pack_path)
+        self.packs.append(gpg_encrypt(pack_path, self.recipients))
+        for chunk_id, location in self.pending.items():
+            self.locations[chunk_id] = [pack_id] + location
+
+
+def chunk_index_file(statedir, remote):
+    # local index of the chunks stored in a remote, dedup never needs the network
+    return os.path.join(statedir, 'repository', remote.name + '.json')
+
+
+def files_cache_file(statedir, folder):
+    # chunks of each file at the last run, unchanged files aren't read again
+    return os.path.join(statedir, 'repository', 'files', folder.name + '.json')
+
+
+def snapshot_packs_file(statedir, remote):
+    # packs referenced by each snapshot uploaded to a remote, for the pack gc
+    return os.path.join(statedir, 'repository', remote.name + '.snapshots.json')
+
+
+def save_chunk_index(statedir, remote, locations, snapshot=None, pack_ids=()):
+    # called once snapshot (its encrypted file name) is uploaded along with its packs
+    index = load_state(chunk_index_file(statedir, remote))
+    index.update(locations)
+    save_state(chunk_index_file(statedir, remote), index)
+    if snapshot is not None:
+        packs = load_state(snapshot_packs_file(statedir, remote))
+        packs[snapshot] = sorted(pack_ids)
+        save_state(snapshot_packs_file(statedir, remote), packs)
+
+
+def pending_bytes(folder, remote, statedir):
+    """
+    returns the bytes of folder that remote may lack, from the files cache of the last run
+    and the chunk index of remote: new or changed files count whole, unchanged files too
+    if one of their chunks isn't in remote, None if the folder was never chunked
+    """
+    cache = load_state(files_cache_file(statedir, folder))
+    if not cache:
+        return None
+    index = load_state(chunk_index_file(statedir, remote))
+    total = 0
+    for relpath, size, mtime_ns, inode in scan_folder(folder['Path']):
+        cached = cache.get(relpath)
+        if cached is None:
+            # directories and links aren't in the cache
+            if os.path.isfile(os.path.join(folder['Path'], relpath)) and \
+                    not os.path.islink(os.path.join(folder['Path'], relpath)):
+                total += size
+        elif cached[:3] != [size, mtime_ns, inode] or any(c not in index for c in cached[3]):
+            total += size
+    return total
+
+
+def snapshot_folder(fname):
+    """
+    returns the folder alias of a snapshot '<time>_<folder>.snapshot.json.gpg', or None
+    """
+    fname = os.path.basename(fname)
+    suffix = SNAPSHOT_MARK + '.gpg'
+    curr_time, sep, rest = fname.partition('_')
+    if not sep or not curr_time.isdigit() or not rest.endswith(suffix):
+        return None
+    return rest[:-len(suffix)] or None
+
+
+def unreferenced_packs(rclone, remote, statedir, remote_root, entries, deleted):
+    """
+    entries: paths of the remote (relative to remote_root), deleted: the ones being deleted
+    returns the paths of the packs no remaining snapshot references, the packs of
+    snapshots uploaded before they were recorded are read from the snapshot itself
+    """
+    from lib.restore import fetch
+    records = load_state(snapshot_packs_file(statedir, remote))
+    prefix = REPO_DIR + '/snapshots/'
+    referenced = set()
+    for path in entries:
+        if not path.startswith(prefix) or path in deleted or snapshot_folder(path) is None:
+            continue
+        name = path[len(prefix):]
+        if name not in records:
+            logging.info("Reading the packs referenced by {}".format(name))
+            snapshot = json.loads(fetch(rclone, remote, remote_root + '/' + path))
+            records[name] = sorted({loc[0] for loc in snapshot['chunks'].values()})
+            save_state(snapshot_packs_file(statedir, remote), records)
+        referenced.update(records[name])
+    prefix = REPO_DIR + '/packs/'
+    return [path for path in entries if path.startswith(prefix) and
+            os.path.basename(path).split('.')[0] not in referenced]
+
+
+def forget_packs(statedir, remote, pack_paths, snapshot_paths):
+    """
+    drops deleted packs from the local chunk index (their chunks are uploaded again
+    when needed) and deleted snapshots from the pack records
+    """
+    pack_ids = {os.path.basename(p).split('.')[0] for p in pack_paths}
+    index = load_state(chunk_index_file(statedir, remote))
+    save_state(chunk_index_file(statedir, remote),
+               {c: loc for c, loc in index.items() if loc[0] not in pack_ids})
+    names = {os.path.basename(p) for p in snapshot_paths}
+    records = load_state(snapshot_packs_file(statedir, remote))
+    save_state(snapshot_packs_file(statedir, remote),
+               {n: ids for n, ids in records.items() if n not in names})
+
+
+def _entry(folder_path, relpath, size, mtime_ns):
+    path = os.path.join(folder_path, relpath)
+    st = os.lstat(path)
+    entry = {'path': relpath, 'mode': stat.S_IMODE(st.st_mode), 'mtime_ns': mtime_ns}
+    if stat.S_ISLNK(st.st_mode):
+        entry.update({'type': 'link', 'target': os.readlink(path)})
+    elif stat.S_ISDIR(st.st_mode):
+        entry.update({'type': 'dir'})
+    elif stat.S_ISREG(st.st_mode):
+        entry.update({'type': 'file', 'size': size})
+    else:
+        return None
+    return entry
+
+
+@timer
+def repository_backup(folder, remotes, workdir, statedir, recipients, pack_size):
+    """
+    splits the files of folder in content defined chunks and packs the ones each remote
+    doesn't have yet, a single pass over the data serves every remote
+    chunks are compressed with the folder's codec, never with 'store'
+    returns {remote name: (encrypted packs, encrypted snapshot, new chunk locations,
+    ids of the packs the snapshot references)}
+    """
+    logging.info("Chunking folder {} for {}".format(
+        folder.name, ' '.join(r.name for r in remotes)))
+    if not is_fast():
+        logging.warning("fastcdc isn't installed, chunking in pure python is slow")
+    curr_time = datetime.now().strftime("%Y%m%d%H%M%S")
+    codec = get_codec(folder['Compression'])
+    indexes = {r.name: load_state(chunk_index_file(statedir, r)) for r in remotes}
+    writers = {r.name: PackWriter(os.path.join(workdir, r.name, REPO_DIR),
+                                  recipients, pack_size) for r in remotes}
+    cache = load_state(files_cache_file(statedir, folder))
+    new_cache = dict()
+    files = []
+    stored = 0
+    read = 0
+
+    def missing(chunk_id):
+        return [r.name for r in remotes
+                if chunk_id not in indexes[r.name] and chunk_id not in writers[r.name]]
+
+    for relpath, size, mtime_ns, inode in sorted(scan_folder(folder['Path'])):
+        entry = _entry(folder['Path'], relpath, size, mtime_ns)
+        if entry is None:
+            continue
+        if entry['type'] == 'file':
+            cached = cache.get(relpath)
+            if cached is not None and cached[:3] == [size, mtime_ns, inode] \
+                    and not any(missing(c) for c in cached[3]):
+                chunks = cached[3]
+            else:
+                chunks = []
+                with open(os.path.join(folder['Path'], relpath), 'rb') as f:
+                    for data in iter_chunks(f):
+                        read += len(data)
+                        chunk_id = hashlib.sha256(data).hexdigest()
+                        chunks.append(chunk_id)
+                        targets = missing(chunk_id)
+                        if not targets:
+                            continue
+                        payload = codec_compress(data, codec)
+                        compressed = str(codec)
+                        if codec.name == 'store' or len(payload) >= len(data):
+                            payload, compressed = data, 0
+                        stored += len(payload)
+                        for name in targets:
+                            writers[name].add(chunk_id, payload, compressed, len(data))
+            entry['chunks'] = chunks
+            new_cache[relpath] = [size, mtime_ns, inode, chunks]
+        files.append(entry)
+    save_state(files_cache_file(statedir, folder), new_cache)
+    METRICS.add_bytes('repository_backup', read, stored)
+    logging.info("{}: {} MB read, {} MB of new chunks".format(
+        folder.name, round(read / (1024 * 1024), 2), round(stored / (1024 * 1024), 2)))
+
+    results = dict()
+    for remote in remotes:
+        writer = writers[remote.name]
+        writer.flush()
+        locations = dict(indexes[remote.name])
+        locations.update(writer.locations)
+        snapshot = {
+            'folder': folder.name,
+            'time': curr_time,
+            'files': files,
+            'chunks': {c: locations[c] for e in files for c in e.get('chunks', [])},
+        }
+        snapshot_path = os.path.join(writer.workdir,
+                                     curr_time + '_' + folder.name + SNAPSHOT_MARK)
+        with open(snapshot_path, 'w') as f:
+            json.dump(snapshot, f)
+        results[remote.name] = (writer.packs, gpg_encrypt(snapshot_path, recipients),
+                                writer.locations,
+                                {loc[0] for loc in snapshot['chunks'].values()})
+    return results
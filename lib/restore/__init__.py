@@ -0,0 +1 @@
+from .restore import *
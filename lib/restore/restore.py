@@ -0,0 +1,472 @@
+import io
+import os
+import sys
+import json
+import bisect
+import zlib
+import shutil
+import hashlib
+import logging
+import tarfile
+from time import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from lib.timer import timer
+from lib.metrics import METRICS
+from lib.chunkinfo import by_chunk_info
+from lib.gpgwrapper import gpg_decrypt_pipe, gpg_decrypt_bytes
+from lib.tarpress import codec_from_name, codec_reader, codec_decompress, get_codec
+from lib.tarpress import FOOTER, MAGIC, is_seekable
+from lib.incremental import DELETED_LIST, is_incremental
+
+
+class ProgressReader:
+    """
+    file-like wrapper counting the bytes read from fileobj, logs the throughput every report bytes
+    """
+
+    def __init__(self, fileobj, total, report=64 * 1024 * 1024):
+        self.fileobj = fileobj
+        self.total = total
+        self.report = report
+        self.processed = 0
+        self.pending = 0
+        self.elapsed = 0
+        self.t0 = time()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.processed += len(data)
+        self.pending += len(data)
+        if self.pending >= self.report or (not data and self.pending):
+            self.elapsed = by_chunk_info(self.total, self.pending, self.processed,
+                                         self.t0, self.elapsed)
+            self.pending = 0
+            self.t0 = time()
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class BlockReader:
+    """
+    read-only file wrapper over the blocks of a seekable archive read from fileobj,
+    the next blocks are decrypted and decompressed by workers while the current one is read
+    """
+
+    def __init__(self, fileobj, blocks, codec, workers=2):
+        self.fileobj = fileobj
+        self.blocks = deque(blocks)
+        self.codec = codec
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = deque()
+        self.max_pending = workers * 2
+        self.buf = b''
+        self.pos = 0
+
+    def _open_block(self, data):
+        return codec_decompress(gpg_decrypt_bytes(data), self.codec)
+
+    def _fill(self):
+        while self.blocks and len(self.pending) < self.max_pending:
+            length = self.blocks.popleft()[1]
+            data = self.fileobj.read(length)
+            while len(data) < length:
+                more = self.fileobj.read(length - len(data))
+                if not more:
+                    raise EOFError("Truncated seekable archive")
+                data += more
+            self.pending.append(self.pool.submit(self._open_block, data))
+
+    def read(self, size=-1):
+        out = []
+        while size != 0:
+            if self.pos == len(self.buf):
+                self._fill()
+                if not self.pending:
+                    break
+                self.buf = self.pending.popleft().result()
+                self.pos = 0
+            n = len(self.buf) - self.pos if size < 0 else min(size, len(self.buf) - self.pos)
+            out.append(self.buf[self.pos:self.pos + n])
+            self.pos += n
+            if size > 0:
+                size -= n
+        return b''.join(out)
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def backup_time(fname):
+    # '<time>_<md5>_<folder>...' or 'ARC_<time>_<folder>...'
+    fname = os.path.basename(fname)
+    if fname.startswith('ARC_'):
+        fname = fname[len('ARC_'):]
+    return int(fname.split('_')[0])
+
+
+def backup_names(names):
+    """
+    returns the names which are backups, the other files (partial uploads,
+    files put there by hand...) are left out with a warning
+    """
+    valid = []
+    for name in names:
+        try:
+            # every backup ends encrypted, '<time>_..._KeePass.tar.gz.gpg.partial' doesn't
+            backup_time(name)
+            if not name.endswith('.gpg'):
+                raise ValueError(name)
+        except ValueError:
+            logging.warning("Ignoring {}, it's not a backup".format(name))
+            continue
+        valid.append(name)
+    return valid
+
+
+def restore_plan(names, backup='latest'):
+    """
+    names: backups stored for a folder, backup: one of them or 'latest'
+    returns the backups to extract in order: the full one and the incrementals up to backup
+    """
+    names = sorted(backup_names(names), key=backup_time)
+    if not names:
+        return []
+    if backup == 'latest':
+        idx = len(names) - 1
+    elif backup in names:
+        idx = names.index(backup)
+    else:
+        return []
+    start = idx
+    while start > 0 and is_incremental(names[start]):
+        start -= 1
+    if is_incremental(names[start]):
+        logging.error("The full backup of {} is missing".format(names[idx]))
+        return []
+    return names[start:idx + 1]
+
+
+def _open(rclone, remote, rpath):
+    # rclone cat | gpg -d, python reads gpg's stdout
+    cat = rclone.cat(remote, rpath)
+    gpg = gpg_decrypt_pipe(cat.stdout)
+    # gpg owns the pipe now, so it gets EOF/SIGPIPE properly
+    cat.stdout.close()
+    return cat, gpg
+
+
+def _close(cat, gpg, rpath):
+    # tar and the codecs may stop before the end of the stream
+    gpg_ret = 0
+    if gpg is not None:
+        while gpg.stdout.read(1024 * 1024):
+            pass
+        gpg.stdout.close()
+        gpg_err = gpg.stderr.read().decode('utf8', 'replace').strip()
+        gpg_ret = gpg.wait()
+    else:
+        while cat.stdout.read(1024 * 1024):
+            pass
+        cat.stdout.close()
+    cat_err = cat.stderr.read().decode('utf8', 'replace').strip()
+    cat_ret = cat.wait()
+    if cat_ret != 0:
+        logging.error("Could not download {}:\n{}".format(rpath, cat_err))
+        sys.exit(1)
+    if gpg_ret != 0:
+        logging.error("Could not decrypt {}:\n{}".format(rpath, gpg_err))
+        sys.exit(1)
+
+
+def _selected(relpath, paths):
+    # paths are relative to the folder, a directory selects everything in it
+    return paths is None or any(relpath == p or relpath.startswith(p + '/') for p in paths)
+
+
+def _safe_path(root, relpath):
+    # paths in the backups are relative to the folder, never outside of it
+    if os.path.isabs(relpath) or '..' in relpath.split(os.sep):
+        logging.warning("Ignoring unsafe path {}".format(relpath))
+        return None
+    return os.path.join(root, relpath)
+
+
+def _requested(relpath, paths):
+    # the paths asked for which relpath is, or is in
+    return {p for p in paths if relpath == p or relpath.startswith(p + '/')}
+
+
+def _apply_deleted(fileobj, root, paths=None, found=None):
+    # found: the paths asked for restored so far, the deleted ones (or in deleted
+    # directories) are taken out of it
+    for relpath in fileobj.read().decode('utf8', 'surrogateescape').splitlines():
+        if paths is not None:
+            gone = {p for p in paths if p == relpath or p.startswith(relpath + '/')}
+            if not gone and not _selected(relpath, paths):
+                continue
+            if found is not None:
+                found.difference_update(gone)
+        path = _safe_path(root, relpath)
+        if path is None:
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+
+def _members(tar, target, paths=None, found=None):
+    # the deleted list of the incrementals is applied instead of extracted,
+    # the paths asked for that are extracted are added to found
+    for member in tar:
+        if os.path.basename(member.name) == DELETED_LIST:
+            _apply_deleted(tar.extractfile(member),
+                           os.path.join(target, os.path.dirname(member.name)), paths, found)
+            continue
+        # members are '<folder basename>/<path in the folder>'
+        relpath = member.name.partition('/')[2]
+        if _selected(relpath, paths):
+            if found is not None and paths is not None:
+                found.update(_requested(relpath, paths))
+            yield member
+
+
+def _extract(tar, target, members):
+    if hasattr(tarfile, 'tar_filter'):
+        tar.extractall(target, members=members, filter='tar')
+    else:
+        tar.extractall(target, members=members)
+
+
+@timer
+def stream_restore(rclone, remote, rpath, size, target, paths=None, found=None):
+    """
+    extracts the backup remote:rpath (only paths if given) into target while it's downloaded,
+    rclone cat | gpg -d | decompress | untar without temporary files
+    found (a set) is updated with the paths restored or deleted, like restore_members()
+    """
+    logging.info("Restoring {} ({} MB) into {}".format(
+        rpath, round(size / (1024 * 1024), 2), target))
+    if is_seekable(rpath):
+        # blocks are decrypted on their own, the index is not part of the tar stream
+        index = read_seekable_index(rclone, remote, rpath, size)
+        blocks_end = sum(b[1] for b in index['blocks'])
+        cat = rclone.cat(remote, rpath, 0, blocks_end)
+        gpg = None
+        reader = ProgressReader(cat.stdout, size)
+        f = BlockReader(reader, index['blocks'], get_codec(index['codec']))
+    else:
+        cat, gpg = _open(rclone, remote, rpath)
+        reader = ProgressReader(gpg.stdout, size)
+        f = codec_reader(reader, codec_from_name(rpath))
+    try:
+        with f, tarfile.open(fileobj=f, mode='r|') as tar:
+            _extract(tar, target, _members(tar, target, paths, found))
+    except Exception as ex:
+        txt = "Failed to restore {0}.\nException of type {1}. Arguments:\n{2!r}"
+        logging.error(txt.format(rpath, type(ex).__name__, ex.args))
+        if gpg is not None:
+            gpg.kill()
+        cat.kill()
+        sys.exit(1)
+    # through the reader, so the totals are logged
+    while reader.read(1024 * 1024):
+        pass
+    _close(cat, gpg, rpath)
+    METRICS.add_bytes('stream_restore', reader.processed, 0)
+
+
+def fetch_range(rclone, remote, rpath, offset, count):
+    """
+    returns count bytes of remote:rpath from offset, as stored (encrypted)
+    """
+    cat = rclone.cat(remote, rpath, offset, count)
+    data = cat.stdout.read()
+    cat.stdout.close()
+    err = cat.stderr.read().decode('utf8', 'replace').strip()
+    if cat.wait() != 0 or len(data) != count:
+        logging.error("Could not download {} bytes at {} of {}:\n{}".format(
+            count, offset, rpath, err))
+        sys.exit(1)
+    return data
+
+
+def read_seekable_index(rclone, remote, rpath, size):
+    """
+    returns the member index of a seekable archive of size bytes, reading only its end
+    """
+    magic, offset, length = FOOTER.unpack(
+        fetch_range(rclone, remote, rpath, size - FOOTER.size, FOOTER.size))
+    if magic != MAGIC:
+        logging.error("{} is not a seekable archive".format(rpath))
+        sys.exit(1)
+    try:
+        return json.loads(gpg_decrypt_bytes(fetch_range(rclone, remote, rpath, offset, length)))
+    except RuntimeError as ex:
+        logging.error("Could not decrypt the index of {}:\n{}".format(rpath, ex))
+        sys.exit(1)
+
+
+@timer
+def restore_members(rclone, remote, rpath, size, target, paths, found=None, workers=2):
+    """
+    extracts paths from the seekable archive remote:rpath into target,
+    downloading only the index and the blocks holding them
+    returns found (a set) with the paths restored added and the ones deleted
+    taken out, an archive may hold none of them (they're in other backups of the chain)
+    """
+    if found is None:
+        found = set()
+    index = read_seekable_index(rclone, remote, rpath, size)
+    codec = get_codec(index['codec'])
+    blocks = index['blocks']
+    starts = [b[2] for b in blocks]
+    # members are '<folder basename>/<path in the folder>'
+    members = [(name, span) for name, span in index['members'].items()
+               if _selected(name.partition('/')[2], paths)
+               or os.path.basename(name) == DELETED_LIST]
+    if not members:
+        logging.info("{} is not in {}".format(' '.join(paths), rpath))
+        return found
+    needed = set()
+    for _, (start, end) in members:
+        first = bisect.bisect_right(starts, start) - 1
+        last = bisect.bisect_left(starts, end) - 1
+        needed.update(range(first, last + 1))
+
+    # contiguous blocks are downloaded with a single ranged read
+    runs = []
+    for i in sorted(needed):
+        if runs and runs[-1][-1] == i - 1:
+            runs[-1].append(i)
+        else:
+            runs.append([i])
+    logging.info("Restoring {} members of {} from {}/{} blocks in {} reads".format(
+        len(members), rpath, len(needed), len(blocks), len(runs)))
+
+    def open_block(data):
+        return codec_decompress(gpg_decrypt_bytes(data), codec)
+
+    plain = dict()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = dict()
+        for run in runs:
+            offset = blocks[run[0]][0]
+            data = fetch_range(rclone, remote, rpath, offset,
+                               sum(blocks[i][1] for i in run))
+            METRICS.add_bytes('restore_members', len(data), 0)
+            for i in run:
+                pos = blocks[i][0] - offset
+                futures[i] = pool.submit(open_block, data[pos:pos + blocks[i][1]])
+        for i, future in futures.items():
+            plain[i] = future.result()
+
+    # children first, so the directories get their mtimes last
+    for name, (start, end) in reversed(members):
+        first = bisect.bisect_right(starts, start) - 1
+        last = bisect.bisect_left(starts, end) - 1
+        span = b''.join(plain[i] for i in range(first, last + 1))
+        span = span[start - starts[first]:end - starts[first]]
+        with tarfile.open(fileobj=io.BytesIO(span), mode='r:') as tar:
+            _extract(tar, target, list(_members(tar, target, paths, found)))
+    return found
+
+
+def fetch(rclone, remote, rpath):
+    """
+    downloads and decrypts remote:rpath in memory, for small files (snapshots, packs)
+    """
+    cat, gpg = _open(rclone, remote, rpath)
+    data = gpg.stdout.read()
+    _close(cat, gpg, rpath)
+    return data
+
+
+@timer
+def restore_snapshot(rclone, remote, repo_rpath, snapshot_name, target, paths=None):
+    """
+    rebuilds the files of a repository snapshot into target, each pack is downloaded once
+    and its chunks written straight to the files using them
+    """
+    logging.info("Restoring snapshot {} into {}".format(snapshot_name, target))
+    snapshot = json.loads(fetch(rclone, remote, repo_rpath + '/snapshots/' + snapshot_name))
+    locations = snapshot['chunks']
+    packs = dict()
+    positions = dict()
+    total = 0
+    entries = []
+    for entry in snapshot['files']:
+        if not _selected(entry['path'], paths):
+            continue
+        path = _safe_path(target, entry['path'])
+        if path is None:
+            continue
+        entries.append((path, entry))
+        if entry['type'] == 'dir':
+            os.makedirs(path, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(path):
+            os.remove(path)
+        if entry['type'] == 'link':
+            os.symlink(entry['target'], path)
+            continue
+        with open(path, 'wb') as f:
+            f.truncate(entry['size'])
+        offset = 0
+        for chunk_id in entry['chunks']:
+            pack_id, pack_offset, length, compressed, size = locations[chunk_id]
+            if chunk_id not in positions:
+                packs.setdefault(pack_id, []).append(
+                    (chunk_id, pack_offset, length, compressed))
+                positions[chunk_id] = []
+                total += length
+            positions[chunk_id].append((path, offset))
+            offset += size
+
+    processed = 0
+    elapsed = 0
+    for pack_id, chunks in packs.items():
+        t0 = time()
+        data = fetch(rclone, remote, repo_rpath + '/packs/' + pack_id + '.pack.gpg')
+        for chunk_id, pack_offset, length, compressed in chunks:
+            payload = data[pack_offset:pack_offset + length]
+            if compressed == 1:
+                # packs from before the chunks followed the folder's codec
+                payload = zlib.decompress(payload)
+            elif compressed:
+                payload = codec_decompress(payload, get_codec(compressed))
+            if hashlib.sha256(payload).hexdigest() != chunk_id:
+                logging.error("Chunk {} in pack {} is corrupted".format(chunk_id, pack_id))
+                sys.exit(1)
+            for path, offset in positions[chunk_id]:
+                with open(path, 'r+b') as f:
+                    f.seek(offset)
+                    f.write(payload)
+            processed += length
+        elapsed = by_chunk_info(total, len(data), processed, t0, elapsed)
+
+    # permissions and mtimes once the content is written, directories last
+    for path, entry in entries:
+        if entry['type'] == 'file':
+            os.chmod(path, entry['mode'])
+            os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+    for path, entry in reversed(entries):
+        if entry['type'] == 'dir':
+            os.chmod(path, entry['mode'])
+            os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
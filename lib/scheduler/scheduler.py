@@ -0,0 +1,110 @@
+import os
+import sys
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+
+
+class ByteBudget:
+    """
+    limits the bytes reserved at the same time (Workdir usage), 0 means unlimited
+    a reservation bigger than the limit waits until it's the only one
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        if not self.limit:
+            return 0
+        nbytes = min(nbytes, self.limit)
+        with self.cond:
+            if self.used + nbytes > self.limit:
+                logging.info("Waiting for {} MB of workdir budget".format(
+                    round(nbytes / (1024 * 1024), 2)))
+            while self.used + nbytes > self.limit:
+                self.cond.wait()
+            self.used += nbytes
+        return nbytes
+
+    def release(self, nbytes):
+        with self.cond:
+            self.used -= nbytes
+            self.cond.notify_all()
+
+
+class WorkdirTiers:
+    """
+    Workdir paths in order of preference (RAM first, then disk), each artifact is written
+    to the first tier with room for it plus headroom, counting the space reserved
+    by the artifacts still being written
+    """
+
+    def __init__(self, paths, headroom=0):
+        self.paths = paths
+        self.headroom = headroom
+        self.reserved = {p: 0 for p in paths}
+        self.lock = threading.Lock()
+        for path in paths:
+            if os.path.exists(path) and not os.path.isdir(path):
+                logging.error("ERROR: WORKDIR NOT SUPPOSED TO BE A FILE! {}".format(path))
+                sys.exit(1)
+            os.makedirs(path, exist_ok=True)
+
+    def free(self, path):
+        return shutil.disk_usage(path).free - self.reserved[path] - self.headroom
+
+    def fits(self, nbytes, total=None):
+        """
+        preflight: an artifact of nbytes fits in a tier and total bytes fit in all of them
+        """
+        with self.lock:
+            free = [self.free(p) for p in self.paths]
+        if total is not None and sum(max(f, 0) for f in free) < total:
+            return False
+        return max(free) >= nbytes
+
+    @contextmanager
+    def reserve(self, nbytes):
+        """
+        yields the tier to write an artifact of about nbytes to, reserved until the block ends
+        """
+        with self.lock:
+            path = next((p for p in self.paths if self.free(p) >= nbytes), None)
+            if path is None:
+                path = max(self.paths, key=self.free)
+                logging.warning("No Workdir tier has {} MB free, using {}".format(
+                    round(nbytes / (1024 * 1024), 2), path))
+            elif path != self.paths[0]:
+                logging.info("Spilling {} MB to Workdir tier {}".format(
+                    round(nbytes / (1024 * 1024), 2), path))
+            self.reserved[path] += nbytes
+        try:
+            yield path
+        finally:
+            with self.lock:
+                self.reserved[path] -= nbytes
+
+
+def when_all(futures, callback):
+    """
+    calls callback() once every future is done (right away if there are none)
+    """
+    if not futures:
+        callback()
+        return
+    lock = threading.Lock()
+    pending = [len(futures)]
+
+    def done(_):
+        with lock:
+            pending[0] -= 1
+            last = pending[0] == 0
+        if last:
+            callback()
+
+    for future in futures:
+        future.add_done_callback(done)
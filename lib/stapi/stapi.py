@@ -1,17 +1,33 @@
 import sys
+import time
 import logging
 import json
+import asyncio
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lib.metrics import METRICS
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
 class Stapi:
-    def __init__(self, apikey, host, port, https):
+    def __init__(self, apikey, host, port, https, timeout=10.0, retries=3):
         self.apikey = apikey
         self.host = host
         self.port = port
         self.https = https
+        self.timeout = timeout
+
+        # keep-alive connections reused by every call (and thread), failed GETs are retried
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=8,
+            max_retries=Retry(total=retries, backoff_factor=0.5,
+                              status_forcelist=[502, 503, 504]),
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
         self.headers = {
             'X-API-Key': self.apikey
@@ -32,6 +48,18 @@ class Stapi:
         return self._request('GET', endpoint, data, headers, params,
                              return_response, raw_exceptions)
 
+    async def aget(self, endpoint, params=None):
+        # the pooled session is shared, each request runs in a worker thread
+        return await asyncio.to_thread(self.get, endpoint, params=params)
+
+    def get_many(self, endpoints):
+        """
+        GETs all the endpoints at the same time, returns the results in the same order
+        """
+        async def gather():
+            return await asyncio.gather(*[self.aget(e) for e in endpoints])
+        return asyncio.run(gather())
+
     def post(self, endpoint, data=None, headers=None, params=None,
              return_response=False, raw_exceptions=False):
         return self._request('POST', endpoint, data, headers, params,
@@ -50,16 +78,19 @@ class Stapi:
 
         headers.update(self.headers)
 
+        t0 = time.time()
         try:
-            resp = requests.request(
+            resp = self.session.request(
                 method,
                 endpoint,
                 data=json.dumps(data),
                 params=params,
                 headers=headers,
-                timeout=10.0,
+                timeout=self.timeout,
                 verify=False
             )
+            METRICS.observe('syncthing', endpoint[len(self.url):].split('?')[0],
+                            time.time() - t0)
 
             if not return_response:
                 resp.raise_for_status()
@@ -0,0 +1 @@
+from .state import *
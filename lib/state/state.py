@@ -0,0 +1,28 @@
+import os
+import json
+import logging
+
+
+def load_state(path):
+    """
+    loads a json state file, returns an empty dict if missing or unreadable
+    """
+    if not os.path.isfile(path):
+        return dict()
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as ex:
+        logging.warning("Could not read state file {}: {}".format(path, ex))
+        return dict()
+
+
+def save_state(path, data):
+    """
+    writes a json state file atomically
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
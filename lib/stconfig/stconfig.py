@@ -1,12 +1,25 @@
 import os
 import sys
 import logging
+import hashlib
+import threading
 import configparser
 from datetime import datetime
-from tabulate import tabulate
+from functools import cached_property
 
 from lib.rclonewrapper import rclone_setup, Rclone
-from lib.stapi import Stapi
+from lib.remoteindex import RemoteIndex
+from lib.tarpress import get_codec
+from lib.state import load_state, save_state
+from lib.manifest import build_manifest
+from lib.scheduler import WorkdirTiers
+from lib.planner import RemoteSpace
+
+
+def tabulate(*args, **kwargs):
+    # imported on first use, it's only needed to print tables
+    from tabulate import tabulate as _tabulate
+    return _tabulate(*args, **kwargs)
 
 
 class Config:
@@ -30,8 +43,11 @@ class Config:
 
         # store archive mode
         self.archive_mode = False
+        # dry run: print the plan of the backup without building anything
+        self.dry_run = False
         if self.args.mode == 'backup':
             self.archive_mode = self.args.archive
+            self.dry_run = getattr(self.args, 'dry_run', False)
 
         # rclone_path is absolute or relative?
         self.rclone_path = self.cfg['DEFAULT']['Rclone_path']
@@ -46,37 +62,114 @@ class Config:
         # remote root path
         self.remote_root = self.cfg['DEFAULT']['Remote_root']
 
-        # load api handler
-        self.stapi = Stapi(
-            self.cfg['DEFAULT']['ST_Apikey'],
-            self.cfg['DEFAULT']['ST_Host'],
-            int(self.cfg['DEFAULT']['ST_Port']),
-            self.cfg['DEFAULT']['ST_Https'].lower() == 'true'
+        # Syncthing api, the handler is created (and contacted) on first use
+        self.st_url = '{proto}://{host}:{port}'.format(
+            proto='https' if self.cfg['DEFAULT']['ST_Https'].lower() == 'true' else 'http',
+            host=self.cfg['DEFAULT']['ST_Host'],
+            port=self.cfg['DEFAULT']['ST_Port']
         )
-
-        # map devicesID (first 7 chars) to their name
-        self.devices = dict()
-        content = self.stapi.get('/rest/system/config?timeout=5')
-        for d in content['devices']:
-            self.devices.update({d['deviceID'].split('-')[0]: d['name']})
+        self.syncthing_loaded = False
+        self.syncthing_lock = threading.Lock()
 
         # recipients
         self.recipients = self.cfg['DEFAULT']['Recipients']
 
-        # workdir is absolute or relative?
-        self.workdir = self.cfg['DEFAULT']['Workdir']
-        if os.path.isabs(self.workdir):
-            self.workdir = os.path.realpath(self.workdir)
-        else:
-            self.workdir = os.path.realpath(
-                os.path.join(self.mypath, self.workdir))
-        # workdir exists?
-        if os.path.exists(self.workdir):
-            if not os.path.isdir(self.workdir):
-                logging.error("ERROR: WORKDIR NOT SUPPOSED TO BE A FILE!")
+        # streaming mode: tar, compress and encrypt in a single pass
+        self.streaming = self.cfg['DEFAULT'].get(
+            'Streaming', 'False').lower() == 'true'
+
+        # extra digests computed while the tar is written (md5 is always computed)
+        self.digests = self.cfg['DEFAULT'].get('Digests', '').lower().split()
+        for algo in self.digests:
+            # shake_* digests need a length, only the fixed size ones are accepted
+            try:
+                fixed = hashlib.new(algo).digest_size > 0 and not algo.startswith('shake')
+            except ValueError:
+                fixed = False
+            if not fixed:
+                logging.error("Unknown or variable length digest algorithm: {}".format(algo))
                 sys.exit(1)
+
+        # number of threads used to compress, 0 means one per cpu
+        self.compress_workers = int(
+            self.cfg['DEFAULT'].get('Compress_workers', '1'))
+        if self.compress_workers <= 0:
+            self.compress_workers = os.cpu_count() or 1
+
+        # workdir tiers, space separated, absolute or relative? (created on first use)
+        self.workdir_paths = []
+        for path in self.cfg['DEFAULT']['Workdir'].split():
+            if os.path.isabs(path):
+                self.workdir_paths.append(os.path.realpath(path))
+            else:
+                self.workdir_paths.append(os.path.realpath(
+                    os.path.join(self.mypath, path)))
+        # MB kept free in each workdir tier
+        self.workdir_headroom = int(
+            self.cfg['DEFAULT'].get('Workdir_headroom', '256')) * 1024 * 1024
+
+        # concurrent uploads, in total and to the same remote
+        self.upload_workers = int(
+            self.cfg['DEFAULT'].get('Upload_workers', '4'))
+        self.upload_per_remote = int(
+            self.cfg['DEFAULT'].get('Upload_per_remote', '1'))
+        if self.upload_workers < 1 or self.upload_per_remote < 1:
+            logging.error("Upload_workers and Upload_per_remote must be at least 1")
+            sys.exit(1)
+
+        # folders prepared at the same time, 0 means one per cpu
+        self.prepare_workers = int(
+            self.cfg['DEFAULT'].get('Prepare_workers', '1'))
+        if self.prepare_workers <= 0:
+            self.prepare_workers = os.cpu_count() or 1
+        # max MB of workdir used by the backups being prepared/uploaded, 0 means unlimited
+        self.workdir_budget = int(
+            self.cfg['DEFAULT'].get('Workdir_budget', '0')) * 1024 * 1024
+
+        # MB of tar data per block in the seekable archives
+        self.block_size = int(
+            self.cfg['DEFAULT'].get('Block_size', '4')) * 1024 * 1024
+
+        # MB of chunks per pack in the deduplicated repository
+        self.pack_size = int(
+            self.cfg['DEFAULT'].get('Pack_size', '16')) * 1024 * 1024
+
+        # statedir keeps information between runs, absolute or relative?
+        self.statedir = self.cfg['DEFAULT'].get('Statedir', 'state')
+        if os.path.isabs(self.statedir):
+            self.statedir = os.path.realpath(self.statedir)
         else:
-            os.mkdir(self.workdir)
+            self.statedir = os.path.realpath(
+                os.path.join(self.mypath, self.statedir))
+        self.manifests_file = os.path.join(self.statedir, 'manifests.json')
+        # last Syncthing event id seen for each folder at its last backup in each remote
+        self.cursors_file = os.path.join(self.statedir, 'st_cursors.json')
+        # Syncthing folder status (sequence...) at its last backup in each remote
+        self.st_status_file = os.path.join(self.statedir, 'st_status.json')
+        # node_exporter textfile with the metrics of the last run, empty to disable
+        self.metrics_textfile = self.cfg['DEFAULT'].get('Metrics_textfile', '')
+        # json report of each run, absolute or relative to the statedir, empty to disable
+        self.reports_dir = self.cfg['DEFAULT'].get('Reports_dir', 'reports')
+        if self.reports_dir:
+            self.reports_dir = os.path.join(self.statedir, self.reports_dir)
+        # rclone backend: 'cli' runs a process per command, 'rcd' a single daemon for the run
+        self.rclone_backend = self.cfg['DEFAULT'].get(
+            'Rclone_backend', 'cli').lower()
+        if self.rclone_backend not in ('cli', 'rcd'):
+            logging.error("Rclone_backend must be cli or rcd: {}".format(
+                self.rclone_backend))
+            sys.exit(1)
+
+        # days between checks for a new rclone version
+        self.rclone_check_ttl = float(
+            self.cfg['DEFAULT'].get('Rclone_check_days', '7')) * 86400
+
+        # hours the listing of the remotes is cached
+        self.index_ttl = float(
+            self.cfg['DEFAULT'].get('Index_ttl', '12')) * 3600
+
+        # folders are prepared in parallel, serialize the state updates
+        self.state_lock = threading.Lock()
 
         # list of folders and remotes
         self.remotes = []
@@ -88,8 +181,8 @@ class Config:
                 # set the local absolute path were the folder lives, and the remote path were backups will be stored
                 fabspath = os.path.realpath(self.cfg[section]['Path'])
                 if self.cfg[section]['Syncthing'].lower() == 'true':
-                    # initialize the changed files count
-                    self.cfg[section]['Changed'] = '0'
+                    # changed files count, set once the Syncthing api is called
+                    self.cfg[section]['Changed'] = '-'
                     frempath = self.remote_root + \
                         '/Syncthing/' + self.cfg[section].name
                 else:
@@ -100,33 +193,115 @@ class Config:
 
                 self.cfg[section]['Path'] = fabspath
                 self.cfg[section]['RPath'] = frempath
-                # call the api for recent changes
-                content = self.stapi.get('/rest/events/disk?timeout=5')
-                for line in content:
-                    fid = line['data']['folderID']
-                    if self.cfg[section]['Id'] == fid:
-                        self.cfg[section]['Changed'] = str(
-                            int(self.cfg[section]['Changed']) + 1)
-                ####################################################
                 # flag to check if we already have the backup ready (checked in backup() loop)
                 self.cfg[section]['BackupReady'] = 'False'
                 # flags to keep track of progress in prepare_backup()
                 self.cfg[section]['MD5'] = 'None'
+                self.cfg[section]['Digests'] = ''
+                # digest of the file manifest (only non Syncthing folders)
+                self.cfg[section]['Manifest'] = 'None'
                 self.cfg[section]['Tar'] = 'None'
+                # bytes of the folder, set by the preflight before the backup is prepared
+                self.cfg[section]['Size'] = '0'
+
+                # compression codec, 'name[:level]'
+                self.cfg[section]['Compression'] = self.cfg[section].get(
+                    'Compression', 'gzip')
+                try:
+                    get_codec(self.cfg[section]['Compression'])
+                except ValueError as ex:
+                    logging.error("Invalid compression for folder {}: {}".format(
+                        self.cfg[section].name, ex))
+                    sys.exit(1)
 
-                if not os.path.isdir(self.cfg[section]['Path']):
-                    logging.error("Path to folder which doesn't exist: {}".format(
-                        self.cfg[section]['Path']))
+                # reproducible tarballs: same content, same md5
+                self.cfg[section]['Reproducible'] = self.cfg[section].get(
+                    'Reproducible', 'False')
+                self.cfg[section]['Mtime_clamp'] = self.cfg[section].get(
+                    'Mtime_clamp', '')
+                # incremental backups, a full one every Full_every backups
+                self.cfg[section]['Incremental'] = self.cfg[section].get(
+                    'Incremental', 'False')
+                self.cfg[section]['Full_every'] = self.cfg[section].get(
+                    'Full_every', '7')
+                if not self.cfg[section]['Full_every'].isdigit() \
+                        or int(self.cfg[section]['Full_every']) < 1:
+                    logging.error("Full_every must be a number greater than 0, folder {}: {}".format(
+                        self.cfg[section].name, self.cfg[section]['Full_every']))
+                    sys.exit(1)
+                # archives made of independent blocks, files can be restored alone
+                self.cfg[section]['Seekable'] = self.cfg[section].get(
+                    'Seekable', 'False')
+                # deduplicated repository instead of tarballs
+                self.cfg[section]['Repository'] = self.cfg[section].get(
+                    'Repository', 'False')
+                try:
+                    reproducible, mtime_clamp = self.tar_options(self.cfg[section])
+                except ValueError:
+                    logging.error("Mtime_clamp must be an epoch timestamp, folder {}: {}".format(
+                        self.cfg[section].name, self.cfg[section]['Mtime_clamp']))
                     sys.exit(1)
+                if mtime_clamp is not None and not reproducible:
+                    logging.warning("Mtime_clamp is ignored in folder {} unless Reproducible = True".format(
+                        self.cfg[section].name))
+
                 # finally append the folder
                 self.folders.append(self.cfg[section])
 
+    @cached_property
+    def stapi(self):
+        # load api handler
+        from lib.stapi import Stapi
+        return Stapi(
+            self.cfg['DEFAULT']['ST_Apikey'],
+            self.cfg['DEFAULT']['ST_Host'],
+            int(self.cfg['DEFAULT']['ST_Port']),
+            self.cfg['DEFAULT']['ST_Https'].lower() == 'true',
+            float(self.cfg['DEFAULT'].get('ST_Timeout', '10')),
+            int(self.cfg['DEFAULT'].get('ST_Retries', '3')),
+        )
+
+    @cached_property
+    def workdir(self):
+        # the tiers are created (and checked) on first use
+        return WorkdirTiers(self.workdir_paths, self.workdir_headroom)
+
+    def check_folder(self, folder):
+        if not os.path.isdir(folder['Path']):
+            logging.error("Path to folder which doesn't exist: {}".format(
+                folder['Path']))
+            sys.exit(1)
+
     def setup_rclone(self, update=True):
         if update:
             # install rclone
-            rclone_setup(self.rclone_path)
-        # rclone class
-        self.rclone = Rclone(self.rclone_bin)
+            rclone_setup(self.rclone_path,
+                         os.path.join(self.statedir, 'rclone_version.json'),
+                         self.rclone_check_ttl)
+        # rclone class, the daemon is started once and reused
+        if self.rclone_backend == 'rcd':
+            from lib.rclonewrapper.rclone_rcd import RcloneRcd
+            if not isinstance(getattr(self, 'rclone', None), RcloneRcd):
+                self.rclone = RcloneRcd(self.rclone_bin)
+        else:
+            self.rclone = Rclone(self.rclone_bin)
+        # cached listing of the remotes, kept across calls so the changes not flushed yet aren't lost
+        if getattr(self, 'index', None) is None:
+            self.index = RemoteIndex(self.rclone, self.remote_root,
+                                     os.path.join(self.statedir, 'remote_index.json'),
+                                     self.index_ttl)
+        self.index.rclone = self.rclone
+        # free space of the remotes, 'about' is called once per remote
+        self.space = RemoteSpace(self.rclone)
+
+    def plan_summary(self, tasks):
+        table = [['Folder', 'Remote', 'Kind', 'Estimate(MB)', 'From', 'Free(MB)', 'Action']]
+        for t in tasks:
+            table.append([t.folder.name, t.remote.name, t.kind,
+                          round(t.estimate / 1048576, 2), t.source,
+                          '?' if t.free is None else round(t.free / 1048576, 2),
+                          'backup' if t.fits else 'skip (no space)'])
+        logging.info('\n' + tabulate(table, headers='firstrow', tablefmt='psql'))
 
     def upl_summary(self, uploaded):
         table = [[k, v] for k, v in uploaded.items()]
@@ -138,8 +313,8 @@ class Config:
         logging.info('\n' + tabulate({"DEFAULT": ['Workdir', 'Recipients', 'ST base endpoint',
                                     'ST Apikey', 'Remote root', 'Rclone Path',
                                     'Total Remotes', 'Total Folders'],
-                        "Value": [self.workdir, self.recipients, self.stapi.url,
-                                  self.stapi.apikey, self.remote_root,
+                        "Value": [' '.join(self.workdir_paths), self.recipients, self.st_url,
+                                  self.cfg['DEFAULT']['ST_Apikey'], self.remote_root,
                                   self.rclone_path,
                                   str(len(self.remotes)) + '  (' + str(
                                       len([r for r in self.remotes if r['Enabled'].lower() != 'true']))
@@ -156,6 +331,7 @@ class Config:
                         "Path": [f['Path'] for f in self.folders],
                         "RPath": [f['RPath'] for f in self.folders],
                         "DOW": [f['DOW'] for f in self.folders],
+                        "Compression": [f['Compression'] for f in self.folders],
                         "Changed": [f['Changed'] for f in self.folders],
                         },
                        headers='keys', tablefmt='psql'))
@@ -182,6 +358,8 @@ class Config:
             return False
         else:
             maxbackups, minfiles = val
+            # the folder path is checked the first time it's needed
+            self.check_folder(folder)
             # disabled?
             if folder['Enabled'].lower() != 'true':
                 logging.info(
@@ -197,13 +375,150 @@ class Config:
                 return False
             # if Syncthing, check if changed < minfiles to skip
             elif folder['Syncthing'].lower() == 'true':
-                if int(folder['Changed']) < int(minfiles):
+                if self.st_status_matches(remote, folder):
+                    logging.info("Skipping {} as its Syncthing sequence didn't move since the last backup in {}".format(
+                        folder.name, remote.name))
+                    return False
+                changed = self.changed(remote, folder)
+                if changed < int(minfiles):
                     logging.info("Skipping {} as it hasn't changed enough files ({} < {})".format(
-                        folder.name, folder['Changed'], minfiles))
+                        folder.name, changed, minfiles))
                     return False
+            # not Syncthing, check if the files changed since the last upload
+            elif self.manifest_matches(remote, folder):
+                logging.info("Skipping {} as its files didn't change since the last backup in {}".format(
+                    folder.name, remote.name))
+                return False
 
         return True
 
+    def manifest_matches(self, remote, folder):
+        if folder['Manifest'] == 'None':
+            folder['Manifest'] = build_manifest(folder['Path'])
+        state = load_state(self.manifests_file)
+        return state.get(remote.name, {}).get(folder.name) == folder['Manifest']
+
+    def mark_backed_up(self, remote, folder):
+        # called once the remote holds a backup of the current folder content,
+        # stores the file manifest and advances the Syncthing event cursor
+        with self.state_lock:
+            if folder['Manifest'] != 'None':
+                state = load_state(self.manifests_file)
+                state.setdefault(remote.name, {})[folder.name] = folder['Manifest']
+                save_state(self.manifests_file, state)
+            if folder['Syncthing'].lower() == 'true':
+                self.load_syncthing()
+                state = load_state(self.cursors_file)
+                state.setdefault(remote.name, {})[
+                    folder.name] = self.last_event_id
+                save_state(self.cursors_file, state)
+                status = self.statuses.get(folder['Id'])
+                if status is not None:
+                    state = load_state(self.st_status_file)
+                    state.setdefault(remote.name, {})[folder.name] = status
+                    save_state(self.st_status_file, state)
+
+    def load_syncthing(self):
+        """
+        fetches the config and the disk events since the oldest cursor at the same time,
+        and keeps the event ids of each folder to count the changes per remote
+        only called once, the first time the Syncthing data is needed
+        """
+        with self.syncthing_lock:
+            if not self.syncthing_loaded:
+                self._load_syncthing()
+                self.syncthing_loaded = True
+
+    def _load_syncthing(self):
+        self.cursors = load_state(self.cursors_file)
+        cursors = [self.cursor(r, f) for r in self.remotes for f in self.folders
+                   if f['Syncthing'].lower() == 'true'
+                   and self.get_idx_in_remote(r, f) >= 0]
+        since = min(cursors or [0])
+        # the status of the folders is only needed to backup
+        st_ids = []
+        if self.args.mode == 'backup':
+            st_ids = [f['Id'] for f in self.folders
+                      if f['Syncthing'].lower() == 'true']
+        config, latest, content, *statuses = self.stapi.get_many([
+            '/rest/system/config?timeout=5',
+            '/rest/events/disk?limit=1&timeout=1',
+            '/rest/events/disk?since={}&timeout=1'.format(since),
+        ] + ['/rest/db/status?folder={}'.format(fid) for fid in st_ids])
+
+        # what identifies the content of a folder: its sequence only moves when it changes
+        self.statuses = dict()
+        for fid, status in zip(st_ids, statuses):
+            if isinstance(status, dict) and 'sequence' in status:
+                self.statuses[fid] = {k: status.get(k) for k in
+                                      ('sequence', 'globalBytes', 'localFiles')}
+
+        # map devicesID (first 7 chars) to their name
+        self.devices = dict()
+        for d in config['devices']:
+            self.devices.update({d['deviceID'].split('-')[0]: d['name']})
+
+        self.last_event_id = 0
+        if latest:
+            self.last_event_id = latest[-1]['id']
+        if cursors and max(cursors) > self.last_event_id:
+            # event ids start again when Syncthing restarts
+            logging.warning(
+                "Syncthing event ids went back, counting all the recent changes")
+            self.cursors = dict()
+            content = self.stapi.get('/rest/events/disk?timeout=1')
+
+        # kept for lastmodified(), a backup lists the changes since its cursors
+        self.disk_events = content
+        self.events = dict()
+        for line in content:
+            if line['id'] > self.last_event_id:
+                # arrived after the limit=1 call, counted on the next run
+                continue
+            self.events.setdefault(
+                line['data']['folderID'], []).append(line['id'])
+
+        for folder in self.folders:
+            if folder['Syncthing'].lower() == 'true':
+                folder['Changed'] = str(len(self.events.get(folder['Id'], [])))
+
+    def st_status_matches(self, remote, folder):
+        # True if the Syncthing folder didn't change since its last backup in remote
+        self.load_syncthing()
+        status = self.statuses.get(folder['Id'])
+        if status is None:
+            return False
+        state = load_state(self.st_status_file)
+        return state.get(remote.name, {}).get(folder.name) == status
+
+    def cursor(self, remote, folder):
+        return self.cursors.get(remote.name, {}).get(folder.name, 0)
+
+    def changed(self, remote, folder):
+        # changed files in folder since its last backup in remote
+        self.load_syncthing()
+        cursor = self.cursor(remote, folder)
+        return len([i for i in self.events.get(folder['Id'], []) if i > cursor])
+
+    def is_incremental(self, folder):
+        # archived backups are always full
+        return folder['Incremental'].lower() == 'true' and not self.archive_mode
+
+    def is_seekable(self, folder):
+        return folder['Seekable'].lower() == 'true'
+
+    def is_repository(self, folder):
+        # archived backups are always tarballs
+        return folder['Repository'].lower() == 'true' and not self.archive_mode
+
+    def tar_options(self, folder):
+        # (reproducible, mtime_clamp) for create_tar() and stream_backup()
+        reproducible = folder['Reproducible'].lower() == 'true'
+        mtime_clamp = None
+        if folder['Mtime_clamp'].strip():
+            mtime_clamp = int(folder['Mtime_clamp'])
+        return reproducible, mtime_clamp
+
     def get_folder_cfg_by_remote(self, remote, folder):
         idx = self.get_idx_in_remote(remote, folder)
         if idx < 0:
@@ -226,6 +541,12 @@ class Config:
                 return f
         return None
 
+    def get_remote_by_alias(self, alias):
+        for r in self.remotes:
+            if r.name == alias:
+                return r
+        return None
+
     def showremoteconfig(self, remote):
         folders_alias = remote['Folders'].split(' ')
         # to keep the order
@@ -245,15 +566,20 @@ class Config:
                         "Maxbackups": maxbackups,
                         "Minfiles": minfiles,
                         "DOW": [f['DOW'] for f in folders],
-                        "Changed": [f['Changed'] for f in folders],
+                        "Changed": [self.changed(remote, f) if f['Syncthing'].lower() == 'true'
+                                    else f['Changed'] for f in folders],
                         },
                        headers='keys', tablefmt='psql'))
 
     def lastmodified(self):
-        # call the api for recent changed files
+        # recent changed files, a backup reuses the events fetched with its cursors
+        self.load_syncthing()
         table = [['Date', 'Time', 'Origin', 'Action', 'Folder',
                   'FolderID', 'Modified By', 'Filename/Path']]
-        content = self.stapi.get('/rest/events/disk?timeout=5')
+        if self.args.mode == 'backup':
+            content = self.disk_events
+        else:
+            content = self.stapi.get('/rest/events/disk?timeout=5')
         for line in content:
             if 'action' not in line['data']:
                 continue
@@ -288,15 +614,11 @@ class Config:
                     continue
 
             table = [[remote.name, 'Folder', 'File', 'Size(MB)']]
-            data = self.rclone.lsf(
-                remote, self.remote_root, use_ls=True, ls_depth='9')
-            for line in data:
-                #'   758132 Syncthing/KeePass/ARC_20200508124150_KeePass.tar.gz.gpg'
-                line = line.strip().split()
-                #['758132', 'Syncthing/KeePass/ARC_20200508124150_KeePass.tar.gz.gpg']
-                size = line[0]  # '758132'
+            data = self.index.entries(remote)
+            for path, size in sorted(data.items()):
+                #'Syncthing/KeePass/ARC_20200508124150_KeePass.tar.gz.gpg', 758132
                 size = str(round(float(size)/1048576, 2))  # '0.72'
-                line = os.path.split(line[1])
+                line = os.path.split(path)
                 #('Syncthing/KeePass', 'ARC_20200508124150_KeePass.tar.gz.gpg')
 
                 filename = line[1]  # 'ARC_20200508124150_KeePass.tar.gz.gpg'
@@ -317,7 +639,7 @@ class Config:
         if self.archive_mode:
             logging.info("Skipping md5 check as archive mode is enabled")
             return False
-        output = self.rclone.lsf(remote, folder['RPath'])
+        output = self.index.list_folder(remote, folder['RPath'])
         for val in output:
             if md5_str in val:
                 logging.debug("MATCH: '{}' is in '{}'".format(md5_str, val))
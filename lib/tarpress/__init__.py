@@ -1,2 +1,6 @@
 from .tar import *
+from .pgzip import *
+from .codecs import *
 from .compress import *
+from .pipeline import *
+from .seekable import *
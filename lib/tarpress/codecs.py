@@ -0,0 +1,133 @@
+import bz2
+import gzip
+import lzma
+import logging
+from collections import namedtuple
+from lib.tarpress.pgzip import gzip_writer
+
+# name: (file extension, default level, min level, max level)
+CODECS = {
+    'gzip': ('gz', 9, 0, 9),
+    'xz': ('xz', 6, 0, 9),
+    'bzip2': ('bz2', 9, 1, 9),
+    'store': ('', None, None, None),
+}
+
+
+class Codec(namedtuple('Codec', ['name', 'extension', 'level'])):
+    @property
+    def suffix(self):
+        # suffix of the (not yet encrypted) backup: .tar.gz, .tar.xz, .tar...
+        if self.extension:
+            return '.tar.' + self.extension
+        return '.tar'
+
+    def __str__(self):
+        if self.level is None:
+            return self.name
+        return '{}:{}'.format(self.name, self.level)
+
+
+def get_codec(spec):
+    """
+    parses a 'name[:level]' string such as 'xz:6', raises ValueError if invalid
+    """
+    name, _, level = spec.strip().lower().partition(':')
+    if name not in CODECS:
+        raise ValueError("Unknown compression codec '{}', valid ones: {}".format(
+            name, ' '.join(CODECS.keys())))
+    extension, default_level, min_level, max_level = CODECS[name]
+    if default_level is None:
+        return Codec(name, extension, None)
+    level = int(level) if level else default_level
+    if not min_level <= level <= max_level:
+        raise ValueError("Compression level for {} must be between {} and {}: '{}'".format(
+            name, min_level, max_level, spec))
+    return Codec(name, extension, level)
+
+
+class _StoreWriter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return self.fileobj.write(data)
+
+    def tell(self):
+        return self.written
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def codec_writer(fileobj, codec, workers=1):
+    """
+    returns a file-like object compressing into fileobj with the given codec,
+    closing it does not close fileobj
+    """
+    logging.debug("Using compression codec {}".format(codec))
+    if codec.name == 'gzip':
+        return gzip_writer(fileobj, workers, codec.level)
+    elif codec.name == 'xz':
+        return lzma.LZMAFile(fileobj, 'wb', preset=codec.level)
+    elif codec.name == 'bzip2':
+        return bz2.BZ2File(fileobj, 'wb', compresslevel=codec.level)
+    return _StoreWriter(fileobj)
+
+
+def codec_from_name(fname):
+    """
+    returns the codec of a backup from its name ('..._KeePass.tar.xz.gpg'), store if unknown
+    """
+    name = fname[:-len('.gpg')] if fname.endswith('.gpg') else fname
+    for codec_name, (extension, default_level, _, _) in CODECS.items():
+        if extension and name.endswith('.tar.' + extension):
+            return Codec(codec_name, extension, default_level)
+    return Codec('store', '', None)
+
+
+def codec_reader(fileobj, codec):
+    """
+    returns a file-like object decompressing fileobj with the given codec
+    """
+    if codec.name == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    elif codec.name == 'xz':
+        return lzma.LZMAFile(fileobj, 'rb')
+    elif codec.name == 'bzip2':
+        return bz2.BZ2File(fileobj, 'rb')
+    return fileobj
+
+
+def codec_compress(data, codec):
+    """
+    one-shot compression of data, for blocks compressed on their own
+    """
+    if codec.name == 'gzip':
+        return gzip.compress(data, compresslevel=codec.level, mtime=0)
+    elif codec.name == 'xz':
+        return lzma.compress(data, preset=codec.level)
+    elif codec.name == 'bzip2':
+        return bz2.compress(data, compresslevel=codec.level)
+    return data
+
+
+def codec_decompress(data, codec):
+    if codec.name == 'gzip':
+        return gzip.decompress(data)
+    elif codec.name == 'xz':
+        return lzma.decompress(data)
+    elif codec.name == 'bzip2':
+        return bz2.decompress(data)
+    return data
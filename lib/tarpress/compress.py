@@ -1,21 +1,32 @@
 import os
+import sys
 import logging
-import gzip
 from time import time
 from lib.timer import timer
 from lib.chunkinfo import by_chunk_info
+from lib.metrics import METRICS
+from lib.tarpress.codecs import get_codec, codec_writer
 
 
 @timer
-def compress(file_path):
-    logging.info("Starting to compress %s", file_path)
+def compress(file_path, workers=1, codec=None, dest_dir=None):
+    # the compressed file goes next to file_path unless dest_dir is given
+    if codec is None:
+        codec = get_codec('gzip')
+    if codec.name == 'store':
+        logging.info("Not compressing %s (store)", file_path)
+        return file_path
+
+    logging.info("Starting to compress %s (%s, %d workers)",
+                 file_path, codec, workers)
     file_size = os.path.getsize(file_path)
     elapsed = 0
     try:
         chunk_size = 64 * 1024 * 1024
-        compressed_path = file_path + '.gz'
-        with open(file_path, 'rb') as fh:
-            with gzip.open(compressed_path, 'wb') as f:
+        compressed_path = os.path.join(dest_dir or os.path.dirname(file_path),
+                                       os.path.basename(file_path) + '.' + codec.extension)
+        with open(file_path, 'rb') as fh, open(compressed_path, 'wb') as out:
+            with codec_writer(out, codec, workers) as f:
                 while True:
                     t0 = time()
                     chunk = fh.read(chunk_size)
@@ -23,13 +34,16 @@ def compress(file_path):
                         break
                     f.write(chunk)
                     elapsed = by_chunk_info(
-                        file_size, chunk_size, f.tell(), t0, elapsed)
+                        file_size, len(chunk), fh.tell(), t0, elapsed)
     except Exception as ex:
         txt = "Failed to compress file.\nException of type {0}. Arguments:\n{1!r}"
         msg = txt.format(type(ex).__name__, ex.args)
         logging.error(msg)
         os.remove(file_path)
+        if os.path.isfile(compressed_path):
+            os.remove(compressed_path)
         sys.exit(1)
 
     os.remove(file_path)
+    METRICS.add_bytes('compress', file_size, os.path.getsize(compressed_path))
     return compressed_path
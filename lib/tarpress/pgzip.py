@@ -0,0 +1,78 @@
+import zlib
+import gzip
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _gzip_member(block, level):
+    # wbits 31 -> deflate with a gzip header and trailer, a complete gzip member
+    co = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return co.compress(block) + co.flush()
+
+
+class ParallelGzipWriter:
+    """
+    file-like object that deflates blocks in a thread pool (zlib releases the GIL)
+    and writes them in order as a multi-member gzip stream readable by gunzip
+    """
+
+    def __init__(self, fileobj, workers, level=9, block_size=8 * 1024 * 1024):
+        self.fileobj = fileobj
+        self.workers = workers
+        self.level = level
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = deque()
+        self.buf = bytearray()
+        self.written = 0
+        self.members = 0
+
+    def write(self, data):
+        self.buf += data
+        self.written += len(data)
+        while len(self.buf) >= self.block_size:
+            block = bytes(self.buf[:self.block_size])
+            del self.buf[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(
+            _gzip_member, block, self.level))
+        self.members += 1
+        # bound memory usage: keep at most two blocks per worker in flight
+        while len(self.pending) > self.workers * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def tell(self):
+        return self.written
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buf or self.members == 0:
+            self._submit(bytes(self.buf))
+            self.buf = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(cancel_futures=True)
+
+
+def gzip_writer(fileobj, workers=1, level=9):
+    """
+    returns a gzip writer for fileobj, parallel if more than one worker is requested
+    """
+    if workers > 1:
+        return ParallelGzipWriter(fileobj, workers, level)
+    return gzip.GzipFile(filename='', mode='wb', fileobj=fileobj,
+                         compresslevel=level, mtime=0)
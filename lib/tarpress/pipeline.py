@@ -0,0 +1,61 @@
+import os
+import sys
+import logging
+import tarfile
+import tempfile
+from lib.timer import timer
+from lib.md5 import HashingWriter
+from lib.metrics import METRICS
+from lib.gpgwrapper import gpg_encrypt_pipe
+from lib.tarpress.codecs import get_codec, codec_writer
+from lib.tarpress.tar import add_folder, add_members
+
+
+@timer
+def stream_backup(folder_path, dest_path, recipients, workers=1, codec=None, digests=(),
+                  reproducible=False, mtime_clamp=None, members=None):
+    """
+    tar -> compress -> gpg in a single pass, the only file written is dest_path
+    returns a dict of hexdigests of the (uncompressed) tar stream
+    members=(changed, deleted) creates an incremental backup with only those paths
+    """
+    logging.info("Starting streaming backup of %s", folder_path)
+    if codec is None:
+        codec = get_codec('gzip')
+    err = tempfile.TemporaryFile()
+    proc = gpg_encrypt_pipe(dest_path, recipients, err)
+    try:
+        with codec_writer(proc.stdin, codec, workers) as cw:
+            hw = HashingWriter(cw, digests)
+            with tarfile.open(fileobj=hw, mode='w|') as tar:
+                if members is None:
+                    add_folder(tar, folder_path, reproducible, mtime_clamp)
+                else:
+                    add_members(tar, folder_path, members,
+                                reproducible, mtime_clamp)
+        proc.stdin.close()
+        ret = proc.wait()
+        if ret != 0:
+            err.seek(0)
+            raise RuntimeError(err.read().decode('utf8', 'replace').strip())
+    except Exception as ex:
+        txt = "Failed to stream the backup.\nException of type {0}. Arguments:\n{1!r}"
+        msg = txt.format(type(ex).__name__, ex.args)
+        logging.error(msg)
+        proc.kill()
+        proc.wait()
+        # a broken pipe is gpg giving up, its reason is in the file
+        err.seek(0)
+        gpg_err = err.read().decode('utf8', 'replace').strip()
+        if gpg_err:
+            logging.error("gpg: {}".format(gpg_err))
+        if os.path.isfile(dest_path):
+            os.remove(dest_path)
+        sys.exit(1)
+    finally:
+        err.close()
+
+    logging.info("Streamed {} MB of tar data into {}".format(
+        round(hw.tell() / (1024 * 1024), 2), dest_path))
+    METRICS.add_bytes('stream_backup', hw.tell(), os.path.getsize(dest_path))
+    return hw.hexdigests()
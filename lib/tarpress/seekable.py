@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import struct
+import logging
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from lib.timer import timer
+from lib.md5 import HashingWriter
+from lib.metrics import METRICS
+from lib.gpgwrapper import gpg_encrypt_bytes
+from lib.tarpress.codecs import get_codec, codec_compress
+from lib.tarpress.tar import _reproducible
+
+# marks seekable archives in their names: <time>_<md5>_<folder>.seek.tar.gz.gpg
+SEEK_MARK = '.seek.'
+# the archive ends with: magic, offset and length of the encrypted index
+FOOTER = struct.Struct('>8sQQ')
+MAGIC = b'STBSEEK1'
+
+
+def is_seekable(fname):
+    return SEEK_MARK in os.path.basename(fname)
+
+
+class BlockWriter:
+    """
+    write-only file wrapper cutting the tar stream in blocks of block_size, each one
+    compressed and encrypted on its own (workers at a time) and appended to fileobj
+    blocks: [[archive offset, archive length, tar offset, tar length], ...]
+    """
+
+    def __init__(self, fileobj, recipients, codec, block_size, workers=1):
+        self.fileobj = fileobj
+        self.recipients = recipients
+        self.codec = codec
+        self.block_size = block_size
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        # blocks being sealed, bounded so memory stays at a few blocks per worker
+        self.pending = deque()
+        self.max_pending = workers * 2
+        self.buf = bytearray()
+        self.tar_offset = 0
+        self.offset = 0
+        self.blocks = []
+
+    def _seal(self, data):
+        return gpg_encrypt_bytes(codec_compress(data, self.codec), self.recipients)
+
+    def _submit(self, data):
+        self.pending.append((self.tar_offset, len(data), self.pool.submit(self._seal, data)))
+        self.tar_offset += len(data)
+        while len(self.pending) > self.max_pending:
+            self._collect()
+
+    def _collect(self):
+        # blocks are written in order, whatever the order they're ready
+        tar_offset, length, future = self.pending.popleft()
+        data = future.result()
+        self.fileobj.write(data)
+        self.blocks.append([self.offset, len(data), tar_offset, length])
+        self.offset += len(data)
+
+    def write(self, data):
+        self.buf += data
+        while len(self.buf) >= self.block_size:
+            self._submit(bytes(self.buf[:self.block_size]))
+            del self.buf[:self.block_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buf:
+            self._submit(bytes(self.buf))
+            self.buf = bytearray()
+        while self.pending:
+            self._collect()
+        self.pool.shutdown()
+
+
+@timer
+def seekable_backup(folder_path, dest_path, recipients, workers=1, codec=None, digests=(),
+                    reproducible=False, mtime_clamp=None, block_size=4 * 1024 * 1024):
+    """
+    tar -> blocks compressed and encrypted independently -> dest_path, followed by the
+    encrypted index {'codec', 'blocks', 'members': {name: [tar start, tar end]}}
+    so single members can be restored reading only their blocks
+    returns a dict of hexdigests of the (uncompressed) tar stream
+    """
+    logging.info("Starting seekable backup of %s", folder_path)
+    if codec is None:
+        codec = get_codec('gzip')
+    members = []
+    try:
+        with open(dest_path, 'wb') as fh:
+            bw = BlockWriter(fh, recipients, codec, block_size, workers)
+            hw = HashingWriter(bw, digests)
+            with tarfile.open(fileobj=hw, mode='w|') as tar:
+                def record(tarinfo):
+                    if reproducible:
+                        tarinfo = _reproducible(tarinfo, mtime_clamp)
+                    # the member (with its extended headers) starts at the current offset
+                    members.append((tarinfo.name, tar.offset))
+                    return tarinfo
+                tar.add(folder_path, arcname=os.path.basename(folder_path),
+                        filter=record)
+                end = tar.offset
+            bw.close()
+            ends = [start for _, start in members[1:]] + [end]
+            index = {
+                'codec': str(codec),
+                'blocks': bw.blocks,
+                'members': {name: [start, stop] for (name, start), stop in zip(members, ends)},
+            }
+            data = gpg_encrypt_bytes(json.dumps(index).encode('utf8', 'surrogateescape'),
+                                     recipients)
+            fh.write(data)
+            fh.write(FOOTER.pack(MAGIC, bw.offset, len(data)))
+    except Exception as ex:
+        txt = "Failed to create the seekable backup.\nException of type {0}. Arguments:\n{1!r}"
+        msg = txt.format(type(ex).__name__, ex.args)
+        logging.error(msg)
+        if os.path.isfile(dest_path):
+            os.remove(dest_path)
+        sys.exit(1)
+
+    logging.info("Wrote {} MB of tar data in {} blocks into {}".format(
+        round(hw.tell() / (1024 * 1024), 2), len(bw.blocks), dest_path))
+    METRICS.add_bytes('seekable_backup', hw.tell(), os.path.getsize(dest_path))
+    return hw.hexdigests()
@@ -1,16 +1,73 @@
+import io
 import os
 import sys
 import logging
 import tarfile
 from lib.timer import timer
+from lib.md5 import HashingWriter
+from lib.metrics import METRICS
+from lib.incremental import DELETED_LIST
+
+
+def _reproducible(tarinfo, mtime_clamp=None):
+    # drop everything that changes without the content changing
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    tarinfo.pax_headers = {}
+    # float mtimes end up as a pax header with sub-second precision
+    tarinfo.mtime = int(tarinfo.mtime)
+    if mtime_clamp is not None and tarinfo.mtime > mtime_clamp:
+        tarinfo.mtime = mtime_clamp
+    return tarinfo
+
+
+def add_folder(tar, folder_path, reproducible=False, mtime_clamp=None):
+    """
+    adds folder_path to tar, tarfile already adds the members in sorted order,
+    in reproducible mode owners are normalized and mtimes truncated/clamped
+    so the same content always produces the same tarball
+    """
+    arcname = os.path.basename(folder_path)
+    if reproducible:
+        tar.add(folder_path, arcname=arcname,
+                filter=lambda ti: _reproducible(ti, mtime_clamp))
+    else:
+        tar.add(folder_path, arcname=arcname)
+
+
+def add_members(tar, folder_path, members, reproducible=False, mtime_clamp=None):
+    """
+    incremental tarball: adds only members=(changed, deleted) relative paths of folder_path,
+    the deleted ones are listed in a DELETED_LIST member
+    """
+    changed, deleted = members
+    arcname = os.path.basename(folder_path)
+    filt = (lambda ti: _reproducible(ti, mtime_clamp)) if reproducible else None
+    for relpath in changed:
+        path = os.path.join(folder_path, relpath)
+        if not os.path.lexists(path):
+            # removed while we were working, it will be in the next deleted list
+            continue
+        tar.add(path, arcname=os.path.join(arcname, relpath),
+                recursive=False, filter=filt)
+    data = ''.join(p + '\n' for p in deleted).encode('utf8', 'surrogateescape')
+    tarinfo = tarfile.TarInfo(os.path.join(arcname, DELETED_LIST))
+    tarinfo.size = len(data)
+    tar.addfile(tarinfo, io.BytesIO(data))
 
 
 @timer
-def create_tar(folder_path, dest_path):
+def create_tar(folder_path, dest_path, digests=(), reproducible=False, mtime_clamp=None):
+    """
+    creates the tarball hashing it while it's written,
+    returns a dict of hexdigests (md5 + the extra digests requested)
+    """
     logging.info("Starting tarball process...")
     try:
-        with tarfile.open(dest_path, 'w') as tar:
-            tar.add(folder_path, arcname=os.path.basename(folder_path))
+        with open(dest_path, 'wb') as fh:
+            hw = HashingWriter(fh, digests)
+            with tarfile.open(fileobj=hw, mode='w') as tar:
+                add_folder(tar, folder_path, reproducible, mtime_clamp)
     except Exception as ex:
         txt = "Failed to tar file.\nException of type {0}. Arguments:\n{1!r}"
         msg = txt.format(type(ex).__name__, ex.args)
@@ -18,4 +75,5 @@ def create_tar(folder_path, dest_path):
         os.remove(dest_path)
         sys.exit(1)
 
-    return tar.name
+    METRICS.add_bytes('create_tar', hw.tell(), hw.tell())
+    return hw.hexdigests()
@@ -1,14 +1,17 @@
 import logging
 from time import time
+from lib.metrics import stage
 
 
 def timer(function):
     """
     wrapper timer function, use with a decorator --> @timer
+    the time is also recorded in the run metrics as a stage named after the function
     """
     def wrapper(*args, **kwargs):
         before = time()
-        rv = function(*args, **kwargs)
+        with stage(function.__name__):
+            rv = function(*args, **kwargs)
         elapsed = time() - before
         logging.info('Function %s() finished in %.3f seconds.',
                      function.__name__, elapsed)
@@ -0,0 +1 @@
+from .uploader import UploadExecutor
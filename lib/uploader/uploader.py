@@ -0,0 +1,62 @@
+import logging
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+
+class UploadExecutor:
+    """
+    runs uploads concurrently with a global cap (max_workers)
+    and a cap on simultaneous uploads to the same remote (per_remote),
+    tasks wait in a per remote queue so they never hold a worker while blocked
+    """
+
+    def __init__(self, max_workers, per_remote=1):
+        self.max_workers = max_workers
+        self.per_remote = per_remote
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.queues = OrderedDict()
+        self.running = dict()
+        self.total_running = 0
+
+    def submit(self, remote_name, fn, *args):
+        future = Future()
+        with self.lock:
+            self.queues.setdefault(remote_name, deque()).append(
+                (future, fn, args))
+            self.running.setdefault(remote_name, 0)
+            self._dispatch()
+        return future
+
+    def _dispatch(self):
+        # called with self.lock held
+        dispatched = True
+        while dispatched and self.total_running < self.max_workers:
+            dispatched = False
+            for remote_name, queue in self.queues.items():
+                if self.total_running >= self.max_workers:
+                    break
+                if queue and self.running[remote_name] < self.per_remote:
+                    future, fn, args = queue.popleft()
+                    self.running[remote_name] += 1
+                    self.total_running += 1
+                    self.executor.submit(
+                        self._run, remote_name, future, fn, args)
+                    dispatched = True
+
+    def _run(self, remote_name, future, fn, args):
+        logging.debug("Upload slot acquired for {}".format(remote_name))
+        try:
+            if future.set_running_or_notify_cancel():
+                future.set_result(fn(*args))
+        except BaseException as ex:
+            future.set_exception(ex)
+        finally:
+            with self.lock:
+                self.running[remote_name] -= 1
+                self.total_running -= 1
+                self._dispatch()
+
+    def shutdown(self):
+        self.executor.shutdown()
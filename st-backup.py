@@ -5,13 +5,24 @@ import argparse
 import logging
 import logging.handlers
 from datetime import datetime
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from lib.stconfig import Config
 from lib.timer import timer
-from lib.tarpress import compress, create_tar
+from lib.tarpress import compress, create_tar, stream_backup, seekable_backup, get_codec, \
+    SEEK_MARK, is_seekable
 from lib.gpgwrapper import gpg_encrypt
-from lib.md5 import md5
 from lib.cleanup import cleanup
+from lib.uploader import UploadExecutor
+from lib.scheduler import ByteBudget, when_all
+from lib.manifest import folder_size
+from lib.metrics import METRICS, labelled, write_reports
+from lib.incremental import INC_MARK, snapshot_scan, diff_snapshot, load_snapshot, save_snapshot
+from lib.repository import REPO_DIR, repository_backup, save_chunk_index, snapshot_folder
+from lib.restore import backup_time, backup_names, restore_plan, stream_restore, \
+    restore_members, restore_snapshot
+from lib.planner import plan_run, by_folder
 
 
 def get_args():
@@ -28,12 +39,26 @@ def get_args():
         'backup', help='Run backup mode.')
     subp_backup.add_argument('-a', '--archive', action='store_true', required=False,
                              help='Archive the backups: Ignores md5sum, minfiles and schedule requisites to perform a backup, also bypasses the cleaning that is performed when maxbackups is reached.')
+    subp_backup.add_argument('-n', '--dry-run', action='store_true', required=False,
+                             help='Print the folders and remotes due, their estimated sizes and the free space of the remotes, without building or uploading anything.')
     subp_listbackups = subparsers.add_parser(
         'list', help='List backups on the remotes.')
     subp_listbackups.add_argument('-r', '--remotealias', nargs=1, type=str, required=False, default=None,
                                   help='Specify a remote alias to filter by it')
     subp_listbackups.add_argument('-f', '--folderalias', nargs=1, type=str, required=False, default=None,
                                   help='Specify a folder alias to filter by it')
+    subp_restore = subparsers.add_parser(
+        'restore', help='Restore a backup from a remote.')
+    subp_restore.add_argument('-r', '--remotealias', nargs=1, type=str, required=True,
+                              help='Remote alias to restore from')
+    subp_restore.add_argument('-f', '--folderalias', nargs=1, type=str, required=True,
+                              help='Folder alias to restore')
+    subp_restore.add_argument('-b', '--backup', nargs=1, type=str, required=False, default=['latest'],
+                              help='Backup (file name as shown by list) to restore, the latest one by default. The full backup and incrementals it depends on are restored too.')
+    subp_restore.add_argument('--file', nargs=1, type=str, required=False, default=None,
+                              help='Restore only this file or directory (relative to the folder). Seekable backups download only the blocks holding it.')
+    subp_restore.add_argument('-t', '--target', nargs=1, type=str, required=True,
+                              help='Directory where the folder is restored')
     subp_lastmodified = subparsers.add_parser(
         'last', help='List recently modified files from ST Api (Only ST folders).')
 
@@ -44,18 +69,43 @@ def get_args():
 def prepare_backup(cfg, remote, folder):
     logging.info("Preparing folder {}...".format(folder.name))
     curr_time = datetime.now().strftime("%Y%m%d%H%M%S")
+    codec = get_codec(folder['Compression'])
+    # seekable archives are always built in a single pass
+    seekable = cfg.is_seekable(folder)
+    single_pass = cfg.streaming or seekable
 
     # check if we've got the md5sum and if we have the tarball ready
     # if we are here, it's because BackupReady == 'False'
     if folder['Tar'] == 'None':
-        # we need to tarball
-        tar_name = curr_time + '_' + folder.name + '.tar'
-        tar_path = os.path.join(cfg.workdir, tar_name)
-        # create the archive
-        create_tar(folder['Path'], tar_path)
+        # we need to tarball, in the first workdir tier with room for the whole folder
+        with cfg.workdir.reserve(int(folder['Size'])) as tier:
+            if seekable:
+                # blocks compressed and encrypted on their own plus an index, 'Tar' holds the result
+                tar_path = os.path.join(
+                    tier, curr_time + '_' + folder.name + SEEK_MARK.rstrip('.') +
+                    codec.suffix + '.gpg')
+                digests = seekable_backup(folder['Path'], tar_path, cfg.recipients,
+                                          cfg.compress_workers, codec, cfg.digests,
+                                          *cfg.tar_options(folder), block_size=cfg.block_size)
+            elif cfg.streaming:
+                # tar, compress and encrypt in one go, 'Tar' holds the encrypted file
+                tar_path = os.path.join(
+                    tier, curr_time + '_' + folder.name + codec.suffix + '.gpg')
+                digests = stream_backup(folder['Path'], tar_path, cfg.recipients,
+                                        cfg.compress_workers, codec, cfg.digests,
+                                        *cfg.tar_options(folder))
+            else:
+                # create the archive, hashed while it's written
+                tar_path = os.path.join(tier, curr_time + '_' + folder.name + '.tar')
+                digests = create_tar(folder['Path'], tar_path, cfg.digests,
+                                     *cfg.tar_options(folder))
         folder['Tar'] = tar_path
-        # check its md5
-        folder['MD5'] = md5(tar_path)
+        folder['MD5'] = digests.pop('md5')
+        # extra digests, 'algo:hexdigest' space separated
+        folder['Digests'] = ' '.join(
+            '{}:{}'.format(k, v) for k, v in digests.items())
+        logging.info("{} md5: {} {}".format(
+            folder.name, folder['MD5'], folder['Digests']))
         if cfg.md5_matches(remote, folder, folder['MD5']):
             # store 'False' in folder['BackupReady']
             logging.info("Skipping folder {} as md5 matches in {}".format(
@@ -72,9 +122,20 @@ def prepare_backup(cfg, remote, folder):
             return folder['BackupReady']
 
     # compress and encrypt
-    compressed_name = compress(folder['Tar'])
-    encrypted_name = gpg_encrypt(compressed_name, cfg.recipients)
-    extension = '.' + encrypted_name.split(".", 1)[-1]
+    if single_pass:
+        # already compressed and encrypted while streaming
+        encrypted_name = folder['Tar']
+    else:
+        # each step may go to another tier, its input is deleted as soon as it's done
+        with cfg.workdir.reserve(os.path.getsize(folder['Tar'])) as tier:
+            compressed_name = compress(
+                folder['Tar'], cfg.compress_workers, codec, tier)
+        with cfg.workdir.reserve(os.path.getsize(compressed_name)) as tier:
+            encrypted_name = gpg_encrypt(compressed_name, cfg.recipients, tier)
+    # the extension carries the codec: .tar.gz.gpg, .tar.xz.gpg, .tar.gpg...
+    extension = codec.suffix + '.gpg'
+    if seekable:
+        extension = SEEK_MARK.rstrip('.') + extension
 
     # if we are in archive mode, remove the MD5 string and add ARC
     if cfg.archive_mode:
@@ -83,30 +144,229 @@ def prepare_backup(cfg, remote, folder):
         backup_path = curr_time + '_' + \
             folder['MD5'] + '_' + folder.name + extension
 
-    backup_path = os.path.join(cfg.workdir, backup_path)
+    backup_path = os.path.join(os.path.dirname(encrypted_name), backup_path)
     os.rename(encrypted_name, backup_path)
     # store backup_path in folder['BackupReady']
     return backup_path
 
 
 @timer
-def upload(cfg, remote, folder):
-    logging.info("Uploading {}".format(folder['BackupReady']))
+def prepare_incremental(cfg, remote, folder, members, size):
+    """
+    creates the incremental backup of folder for remote with members=(changed, deleted),
+    they're built per remote since each remote has its own chain, size: bytes changed
+    """
+    logging.info("Preparing incremental backup of {} for {}: {} changed, {} deleted".format(
+        folder.name, remote.name, len(members[0]), len(members[1])))
+    curr_time = datetime.now().strftime("%Y%m%d%H%M%S")
+    codec = get_codec(folder['Compression'])
+    with cfg.workdir.reserve(size) as tier:
+        workdir = os.path.join(tier, remote.name)
+        os.makedirs(workdir, exist_ok=True)
+        tmp_path = os.path.join(workdir, curr_time + '_' + folder.name + '.tmp')
+        digests = stream_backup(folder['Path'], tmp_path, cfg.recipients,
+                                cfg.compress_workers, codec, cfg.digests,
+                                *cfg.tar_options(folder), members=members)
+    backup_path = os.path.join(workdir, curr_time + '_' + digests['md5'] + '_' +
+                               folder.name + INC_MARK.rstrip('.') + codec.suffix + '.gpg')
+    os.rename(tmp_path, backup_path)
+    return backup_path
+
+
+@timer
+def upload(cfg, remote, folder, backup_path):
+    logging.info("Uploading {}".format(backup_path))
     ret, output = cfg.rclone.upload(
-        remote.name, folder['BackupReady'], folder['RPath'])
+        remote.name, backup_path, folder['RPath'])
     if ret != 0:
         logging.error("The upload failed.\n{}".format(output))
     else:
         logging.info("Upload for {} complete !!!".format(folder.name))
+        size = os.path.getsize(backup_path)
+        METRICS.add_bytes('upload', size, size)
+        cfg.index.add(remote, folder['RPath'] + '/' + os.path.basename(backup_path), size)
 
     return ret
 
 
+@timer
+def repository_upload(cfg, remote, folder, packs, snapshot_path):
+    """
+    uploads the new packs of a folder and then its snapshot, a snapshot is only
+    uploaded once every chunk it references is in the remote
+    """
+    rpath = cfg.remote_root + '/' + REPO_DIR
+    for fname, dest in [(p, rpath + '/packs') for p in packs] + \
+            [(snapshot_path, rpath + '/snapshots')]:
+        logging.info("Uploading {}".format(fname))
+        ret, output = cfg.rclone.upload(remote.name, fname, dest)
+        if ret != 0:
+            logging.error("The upload failed.\n{}".format(output))
+            return ret
+        size = os.path.getsize(fname)
+        METRICS.add_bytes('repository_upload', size, size)
+        cfg.index.add(remote, dest + '/' + os.path.basename(fname), size)
+    logging.info("Upload for {} complete !!!".format(folder.name))
+    return 0
+
+
+def needs_upload(cfg, remote, folder, planned):
+    # folder needs a backup (cfg.should_backup() is True)
+    logging.info(
+        "<<< Folder {} needs a backup in {} >>>".format(folder.name, remote.name))
+    # check if we already have the encrypted backup for this folder
+    if folder['BackupReady'] == 'False':
+        folder['BackupReady'] = prepare_backup(cfg, remote, folder)
+        # if it's still false, we've skipped
+        if folder['BackupReady'] == 'False':
+            cfg.mark_backed_up(remote, folder)
+            cfg.space.release(remote, planned)
+            return False
+    elif cfg.md5_matches(remote, folder, folder['MD5']):
+        logging.info("Skipping folder {} as md5 matches in {}".format(
+            folder.name, remote.name))
+        cfg.mark_backed_up(remote, folder)
+        cfg.space.release(remote, planned)
+        return False
+
+    METRICS.set_max('workdir_bytes', workdir_usage(cfg))
+    logging.info("{} is prepared to upload: {}".format(
+        folder.name, folder['BackupReady']))
+    # the actual size takes the place of the planned one
+    file_size = os.path.getsize(folder['BackupReady'])
+    if not cfg.space.take(remote, file_size, planned):
+        logging.warning(
+            "There isn't enough space in the remote: {} to upload the backup".format(remote.name))
+        METRICS.add_failure('no_space')
+        return False
+    return True
+
+
+def workdir_usage(cfg):
+    return sum(folder_size(path) for path in cfg.workdir.paths)
+
+
+def finish_folder(cfg, folder, budget, reserved, extra_files):
+    # all the uploads of this folder are done, free workdir space right away
+    METRICS.set_max('workdir_bytes', workdir_usage(cfg))
+    for fname in [folder['Tar'], folder['BackupReady']] + extra_files:
+        if os.path.isfile(fname):
+            logging.debug("Deleting {}".format(fname))
+            os.remove(fname)
+    budget.release(reserved)
+
+
+def process_folder(cfg, folder, remotes, estimates, executor, budget):
+    """
+    prepares the backup of a folder for the remotes planned and queues its uploads without
+    waiting for them, estimates: {remote name: bytes planned in it} (see plan_run())
+    returns a list of (remote, upload future, backup name, callback to run once uploaded or None)
+    """
+    logging.info("<<< --- %s --- >>>", folder.name)
+
+    # preflight: a tar plus its compressed copy (maybe in different tiers),
+    # or just the final file when streaming, packs for each remote in a repository
+    size = int(folder['Size'])
+    largest = estimate = size
+    if cfg.is_repository(folder):
+        largest = estimate = size * len(remotes)
+    elif not cfg.streaming and not cfg.is_seekable(folder):
+        estimate = size * 2
+    if not cfg.workdir.fits(largest, estimate):
+        logging.warning("Skipping folder {}: {} MB don't fit in the Workdir tiers".format(
+            folder.name, round(estimate / (1024 * 1024), 2)))
+        METRICS.add_failure('prepare')
+        # the space planned in the remotes is free for the next folders
+        for remote in remotes:
+            cfg.space.release(remote, estimates[remote.name])
+        return []
+    reserved = budget.acquire(estimate)
+
+    futures = []
+    extra_files = []
+    try:
+        full_remotes = remotes
+        scan = None
+        if cfg.is_repository(folder):
+            # deduplicated chunks, every remote gets only the chunks it lacks
+            full_remotes = []
+            with cfg.workdir.reserve(estimate) as tier:
+                results = repository_backup(folder, remotes, tier, cfg.statedir,
+                                            cfg.recipients, cfg.pack_size)
+            for remote in remotes:
+                packs, snapshot_path, locations, pack_ids = results[remote.name]
+                extra_files.extend(packs + [snapshot_path])
+                if not cfg.space.take(remote, sum(os.path.getsize(f) for f in packs + [snapshot_path]),
+                                      estimates[remote.name]):
+                    logging.warning("There isn't enough space in the remote: {} to upload the backup".format(
+                        remote.name))
+                    METRICS.add_failure('no_space')
+                    continue
+                futures.append((remote, executor.submit(
+                    remote.name, labelled(repository_upload, remote=remote.name, folder=folder.name),
+                    cfg, remote, folder, packs, snapshot_path),
+                    os.path.basename(snapshot_path),
+                    partial(save_chunk_index, cfg.statedir, remote, locations,
+                            os.path.basename(snapshot_path), pack_ids)))
+        elif cfg.is_incremental(folder):
+            # remotes whose chain is complete (or missing) get a full backup, the rest an incremental
+            scan = snapshot_scan(folder['Path'])
+            full_remotes = []
+            for remote in remotes:
+                snapshot = load_snapshot(cfg.statedir, remote, folder)
+                if snapshot is None or snapshot['since_full'] + 1 >= int(folder['Full_every']):
+                    full_remotes.append(remote)
+                    continue
+                members = diff_snapshot(snapshot['files'], scan)
+                if not members[0] and not members[1]:
+                    logging.info("Skipping {} as nothing changed since the last backup in {}".format(
+                        folder.name, remote.name))
+                    cfg.space.release(remote, estimates[remote.name])
+                    continue
+                changed = sum(scan[p][0] for p in members[0])
+                with METRICS.context(remote=remote.name):
+                    backup_path = prepare_incremental(cfg, remote, folder, members, changed)
+                extra_files.append(backup_path)
+                if not cfg.space.take(remote, os.path.getsize(backup_path), estimates[remote.name]):
+                    logging.warning("There isn't enough space in the remote: {} to upload the backup".format(
+                        remote.name))
+                    METRICS.add_failure('no_space')
+                    continue
+                futures.append((remote, executor.submit(
+                    remote.name, labelled(upload, remote=remote.name, folder=folder.name),
+                    cfg, remote, folder, backup_path),
+                    os.path.basename(backup_path),
+                    partial(save_snapshot, cfg.statedir, remote, folder, scan, snapshot['since_full'] + 1)))
+
+        for remote in full_remotes:
+            if needs_upload(cfg, remote, folder, estimates[remote.name]):
+                futures.append((remote, executor.submit(
+                    remote.name, labelled(upload, remote=remote.name, folder=folder.name),
+                    cfg, remote, folder, folder['BackupReady']),
+                    os.path.basename(folder['BackupReady']),
+                    None if scan is None else partial(save_snapshot, cfg.statedir, remote, folder, scan, 0)))
+    except BaseException:
+        # sys.exit() from a failed step too: the uploads already queued are let finish,
+        # then the artifacts are removed and the budget released, or the workers
+        # waiting for it would block the pool forever
+        METRICS.add_failure('prepare')
+        wait([f for _, f, _, _ in futures])
+        for fname in [folder['Tar'], folder['BackupReady']] + extra_files:
+            if os.path.isfile(fname):
+                os.remove(fname)
+        budget.release(reserved)
+        raise
+    when_all([f for _, f, _, _ in futures],
+             lambda: finish_folder(cfg, folder, budget, reserved, extra_files))
+    return futures
+
+
 @timer
 def backup(cfg):
     logging.info("Starting backup mode...")
-    cfg.setup_rclone()
+    cfg.setup_rclone(update=not cfg.dry_run)
     uploaded = dict()
+    remotes = []
     for remote in cfg.remotes:
         uploaded.update({remote.name: ""})
         logging.info("<<< --- %s --- >>>", remote.name)
@@ -114,41 +374,94 @@ def backup(cfg):
         if remote['Enabled'].lower() != 'true':
             logging.info("Skipping this remote as it's disabled")
             continue
-
         cfg.showremoteconfig(remote)
-        for folder in cfg.folders:
-            # skip folders that do not meet the reqs for backup
-            if not cfg.should_backup(remote, folder):
-                continue
-            # folder needs a backup
-            logging.info(
-                "<<< Folder {} needs a backup >>>".format(folder.name))
-            # check if we already have the encrypted backup for this folder
-            if folder['BackupReady'] == 'False':
-                folder['BackupReady'] = prepare_backup(cfg, remote, folder)
-                # if it's still false, we've skipped
-                if folder['BackupReady'] == 'False':
-                    continue
-            elif cfg.md5_matches(remote, folder, folder['MD5']):
-                logging.info("Skipping folder {} as md5 matches in {}".format(
-                    folder.name, remote.name))
-                continue
-
-            logging.info("{} is prepared to upload: {}".format(
-                folder.name, folder['BackupReady']))
-            file_size = os.path.getsize(folder['BackupReady'])
-            if not cfg.rclone.check_space(remote, file_size):
-                logging.warning(
-                    "There isn't enough space in the remote: {} to upload the backup".format(remote.name))
-                continue
-            # all ready to upload
-            if upload(cfg, remote, folder) == 0:
-                uploaded.update(
-                    {remote.name: uploaded[remote.name] + '\n' + os.path.basename(folder['BackupReady'])})
+        remotes.append(remote)
+
+    # the pairs due and their sizes are known before anything is built,
+    # folders no remote has room for are never prepared
+    tasks = plan_run(cfg, remotes)
+    if cfg.dry_run:
+        cfg.plan_summary(tasks)
+        return None
+    plan = by_folder(tasks)
+
+    # folders are prepared in parallel, and each backup is uploaded to every remote
+    # that needs it as soon as it's ready, while the next folders are being prepared
+    executor = UploadExecutor(cfg.upload_workers, cfg.upload_per_remote)
+    budget = ByteBudget(cfg.workdir_budget)
+    with ThreadPoolExecutor(max_workers=cfg.prepare_workers) as pool:
+        jobs = [pool.submit(labelled(process_folder, folder=folder.name),
+                            cfg, folder, due, estimates, executor, budget)
+                for folder, due, estimates in plan]
+        for job, (folder, _, _) in zip(jobs, plan):
+            for remote, future, fname, on_success in job.result():
+                if future.result() == 0:
+                    cfg.mark_backed_up(remote, folder)
+                    if on_success is not None:
+                        on_success()
+                    uploaded.update(
+                        {remote.name: uploaded[remote.name] + '\n' + fname})
+                else:
+                    METRICS.add_failure('upload')
+    executor.shutdown()
 
     return uploaded
 
 
+@timer
+def restore(cfg):
+    logging.info("Starting restore mode...")
+    cfg.setup_rclone(update=False)
+    remote = cfg.get_remote_by_alias(cfg.args.remotealias[0])
+    folder = cfg.get_folder_by_alias(cfg.args.folderalias[0])
+    if remote is None or folder is None:
+        logging.error("Unknown remote or folder alias: {} {}".format(
+            cfg.args.remotealias[0], cfg.args.folderalias[0]))
+        sys.exit(1)
+    target = os.path.realpath(cfg.args.target[0])
+    os.makedirs(target, exist_ok=True)
+    paths = None if cfg.args.file is None else [cfg.args.file[0].strip('/')]
+
+    # tarballs (full and incrementals) in the folder path, snapshots in the repository
+    entries = cfg.index.entries(remote)
+    prefix = cfg.index.relpath(folder['RPath']) + '/'
+    backups = {p[len(prefix):]: size for p, size in entries.items()
+               if p.startswith(prefix) and '/' not in p[len(prefix):]}
+    backups = {name: backups[name] for name in backup_names(backups)}
+    prefix = REPO_DIR + '/snapshots/'
+    snapshots = [p[len(prefix):] for p in entries
+                 if p.startswith(prefix) and snapshot_folder(p) == folder.name]
+
+    backup = cfg.args.backup[0]
+    if backup == 'latest' and snapshots:
+        # the folder may have been switched to (or from) a repository
+        latest = max(list(backups) + snapshots, key=backup_time)
+        backup = latest if latest in snapshots else backup
+    if backup in snapshots:
+        # a snapshot is complete on its own, tarballs hold the folder's basename too
+        restore_snapshot(cfg.rclone, remote, cfg.remote_root + '/' + REPO_DIR, backup,
+                         os.path.join(target, os.path.basename(os.path.normpath(folder['Path']))),
+                         paths)
+        return
+    plan = restore_plan(backups, backup)
+    if not plan:
+        logging.error("No backup {} of {} in {}".format(
+            backup, folder.name, remote.name))
+        sys.exit(1)
+    # a path may be in the full backup or only in a later incremental
+    found = set()
+    for fname in plan:
+        rpath = folder['RPath'] + '/' + fname
+        if paths is not None and is_seekable(fname):
+            restore_members(cfg.rclone, remote, rpath, backups[fname], target, paths, found)
+        else:
+            stream_restore(cfg.rclone, remote, rpath, backups[fname], target, paths, found)
+    if paths is not None and not found:
+        logging.error("{} is not in backup {} of {}".format(
+            ' '.join(paths), plan[-1], folder.name))
+        sys.exit(1)
+
+
 def main():
     logger = logging.getLogger('')
     logger.setLevel(logging.INFO)
@@ -171,13 +484,27 @@ def main():
 
     if cfg.args.mode == 'showconfig':
         cfg.showconfig()
-    elif cfg.args.mode == 'backup':
-        cfg.lastmodified()
-        uploaded = backup(cfg)
-        cfg.upl_summary(uploaded)
-        cleanup(cfg)
-        # restart syncthing to reset recent changed files
-        cfg.stapi.post('/rest/system/restart')
+    elif cfg.args.mode == 'backup' and cfg.dry_run:
+        backup(cfg)
+    elif cfg.args.mode in ('backup', 'restore'):
+        # the metrics are written even if the run fails
+        success = False
+        try:
+            if cfg.args.mode == 'backup':
+                cfg.lastmodified()
+                uploaded = backup(cfg)
+                cfg.upl_summary(uploaded)
+                cleanup(cfg)
+            else:
+                restore(cfg)
+            # failed uploads or prepares don't stop a backup, but it didn't succeed
+            success = not METRICS.failed()
+        finally:
+            # the uploads and deletes are only in memory until then
+            if getattr(cfg, 'index', None) is not None:
+                cfg.index.flush()
+            write_reports(cfg.metrics_textfile, cfg.reports_dir,
+                          cfg.args.mode, success)
     elif cfg.args.mode == 'list':
         cfg.listbackups(ralias=cfg.args.remotealias,
                         falias=cfg.args.folderalias)
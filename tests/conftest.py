@@ -0,0 +1,94 @@
+import os
+import sys
+import shutil
+import subprocess
+import pytest
+
+# the modules are imported as lib.<package>, like st-backup.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RECIPIENT = 'st-backup-test@example.invalid'
+
+# cat [offset [count]] of a local file, what 'rclone cat --offset --count' does
+_CAT = """
+import sys
+with open(sys.argv[1], 'rb') as f:
+    f.seek(int(sys.argv[2]))
+    count = int(sys.argv[3])
+    sys.stdout.buffer.write(f.read() if count < 0 else f.read(count))
+"""
+
+
+class LocalRclone:
+    """
+    stands in for Rclone in the restore functions, remote paths are local files
+    """
+
+    def cat(self, remote, filepath, offset=None, count=None):
+        cmd = [sys.executable, '-c', _CAT, filepath, str(offset or 0),
+               str(-1 if count is None else count)]
+        return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+@pytest.fixture(scope='session')
+def recipient(tmp_path_factory):
+    """
+    a throwaway gpg key in its own GNUPGHOME, the backups are encrypted for it
+    """
+    if shutil.which('gpg') is None:
+        pytest.skip('gpg is not installed')
+    home = str(tmp_path_factory.mktemp('gnupg'))
+    os.chmod(home, 0o700)
+    previous = os.environ.get('GNUPGHOME')
+    os.environ['GNUPGHOME'] = home
+    subprocess.run(['gpg', '--batch', '--pinentry-mode', 'loopback', '--passphrase', '',
+                    '--quick-gen-key', RECIPIENT, 'default', 'default', 'never'],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    yield RECIPIENT
+    subprocess.run(['gpgconf', '--kill', 'gpg-agent'],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if previous is None:
+        del os.environ['GNUPGHOME']
+    else:
+        os.environ['GNUPGHOME'] = previous
+
+
+@pytest.fixture
+def rclone():
+    return LocalRclone()
+
+
+@pytest.fixture
+def folder(tmp_path):
+    """
+    a small folder to back up: text, incompressible data, nested directories,
+    an empty directory and a symlink
+    """
+    path = tmp_path / 'src' / 'Docs'
+    (path / 'sub' / 'deep').mkdir(parents=True)
+    (path / 'empty').mkdir()
+    (path / 'notes.txt').write_text('some notes\n' * 1000)
+    (path / 'sub' / 'random.bin').write_bytes(os.urandom(300 * 1024))
+    (path / 'sub' / 'deep' / 'small.txt').write_text('small')
+    os.symlink('notes.txt', str(path / 'link'))
+    return str(path)
+
+
+def tree(root):
+    """
+    returns {relative path: content} of root, ('dir',) and ('link', target) for
+    directories and symlinks, to compare a restore with its source
+    """
+    out = dict()
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, root)
+            if os.path.islink(path):
+                out[relpath] = ('link', os.readlink(path))
+            elif os.path.isdir(path):
+                out[relpath] = ('dir',)
+            else:
+                with open(path, 'rb') as f:
+                    out[relpath] = f.read()
+    return out
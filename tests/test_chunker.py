@@ -0,0 +1,50 @@
+import io
+import random
+import pytest
+from lib.repository import chunker
+
+# small chunks, the pure python fallback is slow
+SIZES = dict(min_size=2 * 1024, avg_size=8 * 1024, max_size=32 * 1024)
+
+
+def _data(size, seed=1):
+    return random.Random(seed).randbytes(size)
+
+
+def _chunks(data, **kwargs):
+    return list(chunker.iter_chunks(io.BytesIO(data), **dict(SIZES, **kwargs)))
+
+
+def test_chunks_cover_the_data_within_bounds():
+    data = _data(512 * 1024)
+    chunks = _chunks(data)
+    assert b''.join(chunks) == data
+    assert all(len(c) <= SIZES['max_size'] for c in chunks)
+    assert all(len(c) >= SIZES['min_size'] for c in chunks[:-1])
+    assert _chunks(b'') == []
+
+
+def test_boundaries_survive_an_insert():
+    data = _data(512 * 1024)
+    edited = data[:200000] + b'inserted bytes' + data[200000:]
+    before, after = _chunks(data), _chunks(edited)
+    # only the chunks around the insert change
+    assert len(set(before) - set(after)) <= 2
+    assert len(set(after) - set(before)) <= 2
+
+
+def test_window_doesnt_move_the_boundaries(monkeypatch):
+    data = _data(512 * 1024)
+    whole = _chunks(data)
+    # read in pieces a few times max_size long, cut points near the end are redone
+    monkeypatch.setattr(chunker, 'WINDOW', 3 * SIZES['max_size'] + 1000)
+    assert _chunks(data) == whole
+
+
+def test_fallback_cuts_like_fastcdc(monkeypatch):
+    if not chunker.is_fast():
+        pytest.skip('fastcdc is not installed')
+    data = _data(512 * 1024)
+    fast = _chunks(data)
+    monkeypatch.setattr(chunker, '_fastcdc', None)
+    assert _chunks(data) == fast
@@ -0,0 +1,49 @@
+from lib.cleanup import plan_retention
+
+
+def test_full_backups_over_the_limit():
+    entries = {
+        'Syncthing/Docs/20240101000000_a_Docs.tar.gz.gpg': 1,
+        'Syncthing/Docs/20240103000000_c_Docs.tar.gz.gpg': 1,
+        'Syncthing/Docs/20240102000000_b_Docs.tar.gz.gpg': 1,
+        'Syncthing/Keys/20240101000000_a_Keys.tar.gz.gpg': 1,
+    }
+    plan = plan_retention(entries, {'Docs': 1, 'Keys': 1})
+    # oldest first, folders within their limit aren't in the plan
+    assert plan == {'Docs': (3, ['Syncthing/Docs/20240101000000_a_Docs.tar.gz.gpg',
+                                 'Syncthing/Docs/20240102000000_b_Docs.tar.gz.gpg'])}
+
+
+def test_chains_are_kept_or_deleted_whole():
+    chain1 = ['Syncthing/Docs/20240101000000_a_Docs.tar.gz.gpg',
+              'Syncthing/Docs/20240102000000_b_Docs.inc.tar.gz.gpg',
+              'Syncthing/Docs/20240103000000_c_Docs.inc.tar.gz.gpg']
+    chain2 = ['Syncthing/Docs/20240104000000_d_Docs.tar.gz.gpg',
+              'Syncthing/Docs/20240105000000_e_Docs.inc.tar.gz.gpg']
+    chain3 = ['Syncthing/Docs/20240106000000_f_Docs.seek.tar.gz.gpg']
+    entries = dict.fromkeys(chain1 + chain2 + chain3, 1)
+    assert plan_retention(entries, {'Docs': 2}) == {'Docs': (3, chain1)}
+    assert plan_retention(entries, {'Docs': 1}) == {'Docs': (3, chain1 + chain2)}
+    assert plan_retention(entries, {'Docs': 3}) == {}
+
+
+def test_archives_and_unknown_folders_are_left_alone():
+    entries = dict.fromkeys([
+        'Syncthing/Docs/ARC_20240101000000_Docs.tar.gz.gpg',
+        'Syncthing/Docs/ARC_20240102000000_Docs.tar.gz.gpg',
+        'Syncthing/Docs/20240103000000_c_Docs.tar.gz.gpg',
+        'Syncthing/Old/20240101000000_a_Old.tar.gz.gpg',
+        'Syncthing/Old/20240102000000_b_Old.tar.gz.gpg',
+    ], 1)
+    assert plan_retention(entries, {'Docs': 1}) == {}
+
+
+def test_repository_snapshots_count_for_their_folder():
+    snapshots = ['Repository/snapshots/2024010{}000000_Docs.snapshot.json.gpg'.format(i)
+                 for i in range(1, 4)]
+    entries = dict.fromkeys(snapshots + [
+        'Repository/snapshots/20240101000000_My_Docs.snapshot.json.gpg',
+        'Repository/packs/0123456789abcdef0123456789abcdef.pack.gpg',
+    ], 1)
+    # packs are left to the pack gc, other folders' snapshots to their own limit
+    assert plan_retention(entries, {'Docs': 2, 'My_Docs': 1}) == {'Docs': (3, snapshots[:1])}
@@ -0,0 +1,45 @@
+import configparser
+from lib.planner import RemoteSpace, Task, by_folder
+
+
+class AboutRclone:
+    def __init__(self, free):
+        self.free = free
+        self.calls = 0
+
+    def about(self, remote):
+        self.calls += 1
+        return {} if self.free[remote.name] is None else {'free': self.free[remote.name]}
+
+
+def _sections(*names):
+    cp = configparser.ConfigParser()
+    cp.read_dict({name: {} for name in names})
+    return [cp[name] for name in names]
+
+
+def test_remote_space():
+    a, b = _sections('A', 'B')
+    rclone = AboutRclone({'A': 1000, 'B': None})
+    space = RemoteSpace(rclone)
+    assert space.take(a, 600)
+    assert not space.take(a, 600)
+    # the backup came out smaller than planned
+    assert space.take(a, 300, 600)
+    assert space.free(a) == 700
+    space.release(a, 200)
+    assert space.free(a) == 900
+    # remotes which don't report their free space are never full
+    assert space.take(b, 10 ** 15)
+    assert rclone.calls == 2
+
+
+def test_by_folder_leaves_out_what_doesnt_fit():
+    f1, f2, a, b = _sections('F1', 'F2', 'A', 'B')
+    tasks = [Task(f1, a, 'full', 10, 'folder', 100, True),
+             Task(f1, b, 'full', 10, 'folder', 5, False),
+             Task(f2, a, 'full', 20, 'history', 90, False),
+             Task(f2, b, 'full', 20, 'history', 5, False)]
+    plan = by_folder(tasks)
+    assert [(f.name, [r.name for r in rs], e) for f, rs, e in plan] == \
+        [('F1', ['A'], {'A': 10})]
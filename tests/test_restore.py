@@ -0,0 +1,113 @@
+import os
+import shutil
+import configparser
+import pytest
+from conftest import tree
+from lib.tarpress import seekable_backup, stream_backup, get_codec
+from lib.restore import restore_plan, restore_members, stream_restore, restore_snapshot
+from lib.incremental import snapshot_scan, diff_snapshot
+from lib.repository import repository_backup
+
+
+def _seekable(folder, dest_dir, recipient, spec='gzip:6'):
+    codec = get_codec(spec)
+    dest = os.path.join(str(dest_dir), '20240101000000_md5_Docs.seek' + codec.suffix + '.gpg')
+    # small blocks, so a member is spread over several of them
+    seekable_backup(folder, dest, recipient, codec=codec, block_size=64 * 1024)
+    return dest
+
+
+@pytest.mark.parametrize('spec', ['gzip:6', 'xz:1', 'store'])
+def test_seekable_stream_roundtrip(folder, tmp_path, recipient, rclone, spec):
+    dest = _seekable(folder, tmp_path, recipient, spec)
+    target = str(tmp_path / 'restored')
+    stream_restore(rclone, None, dest, os.path.getsize(dest), target)
+    assert tree(os.path.join(target, 'Docs')) == tree(folder)
+
+
+def test_restore_members(folder, tmp_path, recipient, rclone):
+    dest = _seekable(folder, tmp_path, recipient)
+    source = tree(folder)
+
+    target = str(tmp_path / 'file')
+    found = restore_members(rclone, None, dest, os.path.getsize(dest), target,
+                            ['sub/random.bin'])
+    assert found == {'sub/random.bin'}
+    restored = tree(os.path.join(target, 'Docs'))
+    assert restored['sub/random.bin'] == source['sub/random.bin']
+    assert 'notes.txt' not in restored
+
+    # a directory brings everything in it
+    target = str(tmp_path / 'dir')
+    restore_members(rclone, None, dest, os.path.getsize(dest), target, ['sub'])
+    assert tree(os.path.join(target, 'Docs', 'sub')) == tree(os.path.join(folder, 'sub'))
+
+    # not an error on its own, the path may be in another backup of the chain
+    assert restore_members(rclone, None, dest, os.path.getsize(dest),
+                           str(tmp_path / 'none'), ['missing']) == set()
+
+
+def test_file_from_a_later_incremental(folder, tmp_path, recipient, rclone):
+    scan = snapshot_scan(folder)
+    full = _seekable(folder, tmp_path, recipient)
+    with open(os.path.join(folder, 'added.txt'), 'w') as f:
+        f.write('added')
+    shutil.rmtree(os.path.join(folder, 'sub', 'deep'))
+    inc = str(tmp_path / '20240102000000_md5_Docs.inc.tar.gz.gpg')
+    stream_backup(folder, inc, recipient, members=diff_snapshot(scan, snapshot_scan(folder)))
+
+    def restore(path, target):
+        found = set()
+        restore_members(rclone, None, full, os.path.getsize(full), target, [path], found)
+        stream_restore(rclone, None, inc, os.path.getsize(inc), target, [path], found)
+        return found, tree(os.path.join(target, 'Docs'))
+
+    found, restored = restore('added.txt', str(tmp_path / 'a'))
+    assert found == {'added.txt'} and restored == {'added.txt': b'added'}
+    # deleted in the incremental, with its directory
+    found, restored = restore('sub/deep/small.txt', str(tmp_path / 'b'))
+    assert found == set() and 'sub/deep/small.txt' not in restored
+
+
+def test_restore_plan():
+    names = [
+        '20240101000000_a_Docs.tar.gz.gpg',
+        '20240102000000_b_Docs.inc.tar.gz.gpg',
+        '20240103000000_c_Docs.tar.gz.gpg',
+        '20240104000000_d_Docs.inc.tar.gz.gpg',
+        '20240105000000_e_Docs.inc.tar.gz.gpg',
+        # not backups, ignored
+        'notes.txt',
+        '20240106000000_f_Docs.tar.gz.gpg.partial',
+    ]
+    assert restore_plan(names) == names[2:5]
+    assert restore_plan(names, names[1]) == names[0:2]
+    assert restore_plan(names, names[2]) == [names[2]]
+    assert restore_plan(names, 'unknown') == []
+    # the full backup of the chain is gone
+    assert restore_plan(names[3:5]) == []
+
+
+@pytest.mark.parametrize('spec', ['store', 'xz:1', 'gzip:6'])
+def test_repository_roundtrip(folder, tmp_path, recipient, rclone, spec):
+    sections = configparser.ConfigParser()
+    sections.read_dict({'remote': {}, 'Docs': {'Path': folder, 'Compression': spec}})
+    results = repository_backup(sections['Docs'], [sections['remote']],
+                                str(tmp_path / 'workdir'), str(tmp_path / 'state'),
+                                recipient, 1024 * 1024)
+    packs, snapshot, locations, pack_ids = results['remote']
+    codecs = {loc[3] for loc in locations.values()}
+    # the random file never compresses, store never does
+    assert codecs == ({0} if spec == 'store' else {0, spec})
+
+    # laid out like Remote_root/Repository
+    repo = tmp_path / 'Repository'
+    (repo / 'snapshots').mkdir(parents=True)
+    (repo / 'packs').mkdir()
+    shutil.move(snapshot, str(repo / 'snapshots'))
+    for pack in packs:
+        shutil.move(pack, str(repo / 'packs'))
+    target = str(tmp_path / 'restored')
+    restore_snapshot(rclone, None, str(repo), os.path.basename(snapshot), target)
+    # symlinks and directories are in the snapshot too
+    assert tree(target) == tree(folder)